@@ -0,0 +1,23 @@
+"""
+Async handlers for the asyncio tests. They live apart from tests.py,
+which has to keep importing on Python 2.
+"""
+
+import asyncio
+from tiny import tiny
+
+async def slow(request):
+	"""Waits without blocking the event loop before answering."""
+
+	await asyncio.sleep(0.2)
+	return tiny.TinyResponse('slow %s' % request.get_data['n'])
+
+async def user(user_id):
+	"""Answers with a path parameter."""
+
+	return tiny.TinyResponse('user %d' % user_id)
+
+async def boom():
+	"""Fails with an unexpected error."""
+
+	raise ValueError('boom')
@@ -0,0 +1,260 @@
+"""
+benchmarks.py drives a TinyApp in-process with synthetic WSGI environs, so
+no sockets are involved, and checks the results against a stored baseline.
+
+	python tests/benchmarks.py                  # run and compare with the baseline
+	python tests/benchmarks.py --save           # run and store the results as the baseline
+	python tests/benchmarks.py render_large     # run some benchmarks only
+
+Each benchmark reports requests/sec, p50/p99 latency in microseconds and
+the peak traced bytes per request (Python 3 only, via tracemalloc). CPython
+has no cheap count of allocations, so the peak memory a request allocates
+is reported in place of allocations per request.
+Each benchmark is run several times and the median of each result is kept.
+Only requests/sec, p50 and peak memory fail the comparison; p99 is too noisy
+to gate on, so a slower p99 is only reported as a warning.
+Baselines are stored per Python version in bench_baseline.json. They depend on
+the machine, so save a new one before comparing on different hardware.
+"""
+
+import argparse, io, json, os, shutil, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tiny import tiny
+
+try:
+	import tracemalloc
+except ImportError:
+	tracemalloc = None
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json')
+PYTHON_VERSION = '%d.%d' % sys.version_info[:2]
+
+_timer = getattr(time, 'perf_counter', time.time)
+
+### Synthetic requests ###
+
+def create_environ(path, method='GET', query='', body=b'', content_type=''):
+	"""Returns a fresh WSGI environ. The body stream is consumed by the request,
+	   so every request needs its own."""
+
+	return {
+		'REQUEST_METHOD': method,
+		'SCRIPT_NAME': '',
+		'PATH_INFO': path,
+		'QUERY_STRING': query,
+		'SERVER_NAME': 'localhost',
+		'SERVER_PORT': '8080',
+		'SERVER_PROTOCOL': 'HTTP/1.1',
+		'CONTENT_TYPE': content_type,
+		'CONTENT_LENGTH': str(len(body)),
+		'HTTP_HOST': 'localhost:8080',
+		'HTTP_USER_AGENT': 'tiny-benchmarks',
+		'wsgi.version': (1, 0),
+		'wsgi.url_scheme': 'http',
+		'wsgi.input': io.BytesIO(body),
+		'wsgi.errors': sys.stderr,
+		'wsgi.multithread': False,
+		'wsgi.multiprocess': False,
+		'wsgi.run_once': False,
+	}
+
+def start_response(status, headers):
+	"""Discards the response head, as the server would after writing it."""
+
+	pass
+
+def call_app(app, environ):
+	"""Makes one request and consumes the body like a server would."""
+
+	body = app(environ, start_response)
+	for chunk in body:
+		pass
+	if hasattr(body, 'close'):
+		body.close()
+
+### Benchmarks ###
+
+FORM_BODY = b'name=tiny&email=tiny%40example.com&message=' + b'hello+world+' * 20
+MULTIPART_BOUNDARY = 'tinybenchmarkboundary'
+MULTIPART_BODY = (
+	b'--tinybenchmarkboundary\r\n'
+	b'Content-Disposition: form-data; name="title"\r\n\r\n'
+	b'benchmark\r\n'
+	b'--tinybenchmarkboundary\r\n'
+	b'Content-Disposition: form-data; name="upload"; filename="data.bin"\r\n'
+	b'Content-Type: application/octet-stream\r\n\r\n'
+	+ b'\x00\x01\x02\x03' * 4096 +
+	b'\r\n--tinybenchmarkboundary--\r\n')
+
+def create_app(template_path):
+	"""Builds the app the benchmarks run against."""
+
+	app = tiny.TinyApp()
+	app.set_template_path(template_path)
+	app.template_auto_reload = False
+
+	app.add_route('/', lambda: tiny.TinyResponse('index'))
+	app.add_route('/users/<int:user_id>/posts/<slug>', lambda user_id, slug: tiny.TinyResponse('%d %s' % (user_id, slug)))
+	app.add_route('/search', lambda request: tiny.TinyResponse(request.get_data.get('q', '')))
+	app.add_route('/form', lambda request: tiny.TinyResponse(request.post_data['name']), ['POST'])
+	app.add_route('/upload', lambda request: tiny.TinyResponse(request.post_data['upload'].filename), ['POST'])
+	app.add_route('/response', lambda: tiny.TinyResponse(['<p>', 'tiny', '</p>'], 201,
+														 [('Content-Type', 'text/plain'), ('Cache-Control', 'no-store'), ('X-Tiny', '1')]))
+	app.add_route('/small', lambda: tiny.TinyResponse(app.render('small.html', title='tiny', name='world')))
+	app.add_route('/large', lambda: tiny.TinyResponse(app.render('large.html', **LARGE_CONTEXT)))
+	return app
+
+SMALL_TEMPLATE = '<html><head><title>{{ title }}</title></head><body>Hello {{ name }}</body></html>'
+LARGE_TEMPLATE = '<html><body>\n' + ''.join('<tr><td>%d</td><td>{{ cell_%d }}</td></tr>\n' % (i, i % 50) for i in range(2000)) + '</body></html>'
+LARGE_CONTEXT = dict(('cell_%d' % i, 'value %d' % i) for i in range(50))
+
+# name -> function returning a fresh environ for one request.
+BENCHMARKS = [
+	('static_route', lambda: create_environ('/')),
+	('param_route', lambda: create_environ('/users/42/posts/hello-world')),
+	('not_found', lambda: create_environ('/missing/page')),
+	('get_query', lambda: create_environ('/search', query='q=tiny+framework&page=2&sort=desc&tag=a&tag=b')),
+	('post_urlencoded', lambda: create_environ('/form', 'POST', body=FORM_BODY, content_type='application/x-www-form-urlencoded')),
+	('post_multipart', lambda: create_environ('/upload', 'POST', body=MULTIPART_BODY,
+											  content_type='multipart/form-data; boundary=' + MULTIPART_BOUNDARY)),
+	('response', lambda: create_environ('/response')),
+	('render_small', lambda: create_environ('/small')),
+	('render_large', lambda: create_environ('/large')),
+]
+
+### Measurement ###
+
+def percentile(sorted_values, fraction):
+	"""Returns the value at a fraction of a sorted list."""
+
+	return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+def run_benchmark(app, make_environ, duration=1.0, min_requests=200, memory_requests=100):
+	"""Runs one benchmark for about `duration` seconds and returns its results.
+	   Memory is measured in a separate pass, as tracing slows every
+	   allocation down."""
+
+	for i in range(min(50, min_requests)):
+		call_app(app, make_environ())
+
+	latencies = []
+	started = _timer()
+	while len(latencies) < min_requests or _timer() - started < duration:
+		environ = make_environ()
+		start = _timer()
+		call_app(app, environ)
+		latencies.append(_timer() - start)
+
+	latencies.sort()
+	results = {
+		'requests_per_sec': round(len(latencies) / sum(latencies), 1),
+		'p50_us': round(percentile(latencies, 0.5) * 1e6, 2),
+		'p99_us': round(percentile(latencies, 0.99) * 1e6, 2),
+	}
+
+	if tracemalloc is not None:
+		peaks = []
+		tracemalloc.start()
+		try:
+			for i in range(memory_requests):
+				environ = make_environ()
+				# clear_traces resets the peak, so the peak is this request's alone.
+				tracemalloc.clear_traces()
+				call_app(app, environ)
+				peaks.append(tracemalloc.get_traced_memory()[1])
+		finally:
+			tracemalloc.stop()
+		results['peak_traced_bytes'] = sorted(peaks)[len(peaks) // 2]
+	return results
+
+def median_results(runs):
+	"""Returns the median of each result over several runs of a benchmark."""
+
+	return dict((key, sorted(run[key] for run in runs)[len(runs) // 2]) for key in runs[0])
+
+def compare(name, results, baseline, tolerance, p99_tolerance):
+	"""Returns (regressions, warnings): the ways a benchmark got worse beyond the
+	   tolerance (a fraction). Tail latency is much noisier than the rest, so
+	   it gets its own tolerance and only ever warns."""
+
+	regressions, warnings = [], []
+	if results['requests_per_sec'] < baseline['requests_per_sec'] * (1 - tolerance):
+		regressions.append('requests/sec %.1f < %.1f' % (results['requests_per_sec'], baseline['requests_per_sec']))
+	for key, allowed, found in (('p50_us', tolerance, regressions), ('peak_traced_bytes', tolerance, regressions),
+								('p99_us', p99_tolerance, warnings)):
+		if key in results and key in baseline and results[key] > baseline[key] * (1 + allowed):
+			found.append('%s %s > %s' % (key, results[key], baseline[key]))
+	return (['%s: %s' % (name, regression) for regression in regressions],
+			['%s: %s' % (name, warning) for warning in warnings])
+
+def load_baseline():
+	"""Returns the stored baselines, keyed by Python version."""
+
+	if not os.path.exists(BASELINE_PATH):
+		return {}
+	with open(BASELINE_PATH) as f:
+		return json.load(f)
+
+def main(argv=None):
+	"""Runs the benchmarks. Exits with 1 if any of them regressed."""
+
+	parser = argparse.ArgumentParser(description='Benchmarks the tiny request pipeline.')
+	parser.add_argument('names', nargs='*', help='benchmarks to run (default: all)')
+	parser.add_argument('--duration', type=float, default=1.0, help='seconds to run each benchmark for')
+	parser.add_argument('--runs', type=int, default=3, help='times to run each benchmark; the median is kept')
+	parser.add_argument('--tolerance', type=float, default=0.25, help='allowed regression, as a fraction of the baseline')
+	parser.add_argument('--p99-tolerance', type=float, default=1.0, help='p99 latency regression to warn about, as a fraction of the baseline')
+	parser.add_argument('--save', action='store_true', help='store the results as the baseline')
+	args = parser.parse_args(argv)
+
+	unknown = set(args.names) - set(name for name, make_environ in BENCHMARKS)
+	if unknown:
+		parser.error('unknown benchmarks: %s' % ', '.join(sorted(unknown)))
+
+	template_path = tempfile.mkdtemp()
+	try:
+		for name, source in (('small.html', SMALL_TEMPLATE), ('large.html', LARGE_TEMPLATE)):
+			with open(os.path.join(template_path, name), 'w') as f:
+				f.write(source)
+		app = create_app(template_path)
+
+		results = {}
+		print('%-16s %12s %10s %10s %18s' % ('benchmark', 'req/s', 'p50 us', 'p99 us', 'peak traced bytes'))
+		for name, make_environ in BENCHMARKS:
+			if args.names and name not in args.names:
+				continue
+			results[name] = median_results([run_benchmark(app, make_environ, args.duration) for i in range(args.runs)])
+			print('%-16s %12.1f %10.2f %10.2f %18s' % (name, results[name]['requests_per_sec'], results[name]['p50_us'],
+													   results[name]['p99_us'], results[name].get('peak_traced_bytes', '-')))
+	finally:
+		shutil.rmtree(template_path)
+
+	baselines = load_baseline()
+	if args.save:
+		baselines.setdefault(PYTHON_VERSION, {}).update(results)
+		with open(BASELINE_PATH, 'w') as f:
+			json.dump(baselines, f, indent=2, separators=(',', ': '), sort_keys=True)
+			f.write('\n')
+		print('Saved the baseline for Python %s.' % PYTHON_VERSION)
+		return 0
+
+	baseline = baselines.get(PYTHON_VERSION)
+	if baseline is None:
+		print('No baseline for Python %s; run with --save to store one.' % PYTHON_VERSION)
+		return 0
+
+	regressions, warnings = [], []
+	for name in sorted(results):
+		if name in baseline:
+			found = compare(name, results[name], baseline[name], args.tolerance, args.p99_tolerance)
+			regressions.extend(found[0])
+			warnings.extend(found[1])
+	for warning in warnings:
+		print('WARNING ' + warning)
+	for regression in regressions:
+		print('REGRESSION ' + regression)
+	return 1 if regressions else 0
+
+if __name__ == '__main__':
+	sys.exit(main())
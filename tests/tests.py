@@ -1,6 +1,11 @@
-import unittest
+import io, json, os, shutil, socket, sys, tempfile, threading, time, unittest, zlib
 from tiny import tiny
 
+try:
+	from http.client import HTTPConnection
+except ImportError:
+	from httplib import HTTPConnection
+
 class TestTinyApp(unittest.TestCase):
 	"""Base class for testing TinyApp."""
 
@@ -47,6 +52,41 @@ class TestTinyApp(unittest.TestCase):
 		template_content = self.app.render('test_render.html', test_var='Testing templates')
 		self.assertEqual(template_content, 'Testing templates')
 
+	def test_render_caches_template(self):
+		"""Tests that a template is compiled once and reused on later renders."""
+
+		template = self.app.get_template('test_render.html')
+		self.assertIs(self.app.get_template('test_render.html'), template)
+
+		self.app.reload_templates('test_render.html')
+		self.assertIsNot(self.app.get_template('test_render.html'), template)
+
+	def test_render_reloads_changed_template(self):
+		"""Tests that a cached template is recompiled when its file changes."""
+
+		template_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, template_dir)
+		template_path = os.path.join(template_dir, 'page.html')
+		self.app.set_template_path(template_dir)
+
+		with open(template_path, 'w') as template_file:
+			template_file.write('<p>{{ name }}</p>')
+		self.assertEqual(self.app.render('page.html', name='old'), '<p>old</p>')
+
+		with open(template_path, 'w') as template_file:
+			template_file.write('<h1>{{ name }}</h1>')
+		os.utime(template_path, (0, 0))
+		self.assertEqual(self.app.render('page.html', name='new'), '<h1>new</h1>')
+
+	def test_render_stream(self):
+		"""Tests that a streamed render yields the same text as a full render."""
+
+		template = tiny.TinyTemplate('{{ a }} and {{b}}, ' * 1000)
+		template.buffer_size = 64
+		chunks = list(template.stream(a='x', b='y'))
+		self.assertTrue(len(chunks) > 1)
+		self.assertEqual(''.join(chunks), template.render(a='x', b='y'))
+
 class TestRequestHandler(unittest.TestCase):
 	"""Base class for testing the request_handler method."""
 
@@ -69,7 +109,7 @@ class TestRequestHandler(unittest.TestCase):
 		
 		environ = create_environ('/index', 'GET')
 		response = self.app.request_handler(environ, lambda x, y: None)
-		self.assertEqual(response, 'test')
+		self.assertEqual(response, [b'test'])
 
 	def test_request_handler_working_post_path(self):
 		"""Tests that the request handler receives a request for a defined path and
@@ -77,7 +117,7 @@ class TestRequestHandler(unittest.TestCase):
 		
 		environ = create_environ('/index', 'POST')
 		response = self.app.request_handler(environ, lambda x, y: None)
-		self.assertEqual(response, 'test')
+		self.assertEqual(response, [b'test'])
 
 	def test_request_handler_404(self):
 		"""Tests that the request handler receives a request for an undefined path and
@@ -85,7 +125,25 @@ class TestRequestHandler(unittest.TestCase):
 		
 		environ = create_environ('/nonexistent', 'GET')
 		response = self.app.request_handler(environ, lambda x, y: None)
-		self.assertEqual(response, '<a href="http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.5"><h1>404: Not Found</h1></a>')
+		self.assertEqual(response, [b'<a href="http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.5"><h1>404: Not Found</h1></a>'])
+
+	def test_request_handler_hook_http_errors(self):
+		"""Tests that HTTP errors raised while hooks parse the request are answered
+		   with their error response."""
+
+		class LimitedRequest(tiny.TinyRequest):
+			max_body_size = 10
+
+		self.app.request_class = LimitedRequest
+		self.app.add_route('/csrf', lambda: tiny.TinyResponse('ok'), ['POST'],
+						   before=[lambda request: request.post_data.get('token') and None])
+		self.app.add_route('/audit', lambda: tiny.TinyResponse('ok'), ['POST'],
+						   after=[lambda request, response: request.post_data.get('token') and None])
+		for path in ('/csrf', '/audit'):
+			statuses = []
+			environ = create_post_environ(path, b'token=' + b'x' * 100, 'application/x-www-form-urlencoded')
+			self.app.request_handler(environ, lambda status, headers: statuses.append(status))
+			self.assertEqual(statuses, ['413 Request Entity Too Large'])
 
 	def test_request_handler_405(self):
 		"""Tests that the request handler receives a request for a defined path and
@@ -93,7 +151,133 @@ class TestRequestHandler(unittest.TestCase):
 		
 		environ = create_environ('/index', 'PUT')
 		response = self.app.request_handler(environ, lambda x, y: None)
-		self.assertEqual(response, '<a href="http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.6"><h1>405: Method Not Allowed</h1></a>')
+		self.assertEqual(response, [b'<a href="http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.6"><h1>405: Method Not Allowed</h1></a>'])
+
+	def test_request_handler_path_params(self):
+		"""Tests that typed path parameters are converted and passed to the handler,
+		   with or without the request."""
+
+		self.app.add_route('/users/<int:user_id>', lambda request, user_id: tiny.TinyResponse(repr(user_id)))
+		self.app.add_route('/users/<int:user_id>/posts/<slug>', lambda user_id, slug: tiny.TinyResponse(slug))
+		self.app.add_route('/files/<path:filename>', lambda filename: tiny.TinyResponse(filename))
+
+		response = self.app.request_handler(create_environ('/users/42', 'GET'), lambda x, y: None)
+		self.assertEqual(response, [b'42'])
+		response = self.app.request_handler(create_environ('/users/42/posts/hello', 'GET'), lambda x, y: None)
+		self.assertEqual(response, [b'hello'])
+		response = self.app.request_handler(create_environ('/files/a/b.txt', 'GET'), lambda x, y: None)
+		self.assertEqual(response, [b'a/b.txt'])
+		response = self.app.request_handler(create_environ('/users/abc', 'GET'), lambda x, y: None)
+		self.assertEqual(response, [b'<a href="http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.5"><h1>404: Not Found</h1></a>'])
+
+	def test_request_handler_static_route_wins(self):
+		"""Tests that a static route takes precedence over a parameterized one, and that
+		   a parameterized route still serves methods the static route doesn't allow."""
+
+		self.app.add_route('/users/<name>', lambda name: tiny.TinyResponse('user'), ['GET', 'DELETE'])
+		self.app.add_route('/users/new', lambda: tiny.TinyResponse('new'), ['GET'])
+
+		response = self.app.request_handler(create_environ('/users/new', 'GET'), lambda x, y: None)
+		self.assertEqual(response, [b'new'])
+		response = self.app.request_handler(create_environ('/users/new', 'DELETE'), lambda x, y: None)
+		self.assertEqual(response, [b'user'])
+		response = self.app.request_handler(create_environ('/users/new', 'POST'), lambda x, y: None)
+		self.assertEqual(response, [b'<a href="http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.6"><h1>405: Method Not Allowed</h1></a>'])
+
+	def test_request_handler_cache(self):
+		"""Tests that a cached route only calls its handler once per key and that a
+		   matching If-None-Match gets an empty 304."""
+
+		calls = []
+		def handler(request):
+			calls.append(request.get_data.get('page'))
+			return tiny.TinyResponse('page %s' % request.get_data.get('page'))
+
+		cache = tiny.TinyResponseCache(ttl=60, max_entries=10, query_args=['page'])
+		self.app.add_route('/list', handler, cache=cache)
+
+		headers = {}
+		start_response = lambda status, response_headers: headers.update(response_headers, status=status)
+		environ = dict(create_environ('/list', 'GET'), QUERY_STRING='page=2&sort=name')
+		self.assertEqual(self.app.request_handler(environ, start_response), [b'page 2'])
+		etag = headers['ETag']
+		self.assertEqual(self.app.request_handler(dict(environ, QUERY_STRING='page=2'), start_response), [b'page 2'])
+		self.assertEqual(self.app.request_handler(dict(environ, QUERY_STRING='page=3'), start_response), [b'page 3'])
+		self.assertEqual(calls, ['2', '3'])
+		self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+		headers.clear()
+		response = self.app.request_handler(dict(environ, HTTP_IF_NONE_MATCH=etag), start_response)
+		self.assertEqual((response, headers['status'], headers['ETag']), ([b''], '304 Not Modified', etag))
+		self.assertFalse('Content-Length' in headers)
+		self.assertEqual(calls, ['2', '3'])
+
+	def test_request_handler_cache_expires(self):
+		"""Tests that expired entries and uncacheable responses call the handler."""
+
+		calls = []
+		def handler():
+			calls.append(True)
+			return tiny.TinyResponse('expired')
+
+		self.app.add_route('/expired', handler, cache=tiny.TinyResponseCache(ttl=-1))
+		self.app.request_handler(create_environ('/expired', 'GET'), lambda x, y: None)
+		self.app.request_handler(create_environ('/expired', 'GET'), lambda x, y: None)
+		self.assertEqual(len(calls), 2)
+
+		cache = self.app.router.static['/expired'].cache
+		self.assertEqual(cache.lookup(tiny.TinyRequest(create_environ('/expired', 'GET'))), None)
+		self.assertEqual((len(cache.entries), cache.misses), (0, 3))
+
+		self.app.add_route('/stream', lambda: tiny.TinyResponse(iter(['a'])), cache=tiny.TinyResponseCache())
+		self.app.request_handler(create_environ('/stream', 'GET'), lambda x, y: None)
+		self.assertEqual(len(self.app.router.static['/stream'].cache.entries), 0)
+
+	def test_cache_counters_threads(self):
+		"""Tests that hits and misses are counted exactly from many threads."""
+
+		cache = tiny.TinyResponseCache()
+		request = tiny.TinyRequest(create_environ('/index', 'GET'))
+		cache.store(request, tiny.TinyResponse('cached'))
+
+		def look_up():
+			for i in range(2000):
+				cache.lookup(request)
+				cache.lookup(tiny.TinyRequest(create_environ('/missing', 'GET')))
+
+		threads = [threading.Thread(target=look_up) for i in range(4)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertEqual((cache.hits, cache.misses), (8000, 8000))
+
+class TestTinyRouter(unittest.TestCase):
+	"""Base class for testing TinyRouter."""
+
+	def test_match_many_routes(self):
+		"""Tests that the right route is matched out of many parameterized routes."""
+
+		router = tiny.TinyRouter()
+		for i in range(2000):
+			router.add(tiny.TinyRoute('/section%d/<int:item_id>' % i, lambda item_id: None))
+
+		route, params = router.match('/section1999/7', 'GET')
+		self.assertEqual(route.pattern, '/section1999/<int:item_id>')
+		self.assertEqual(params, {'item_id': 7})
+		self.assertEqual(router.match('/section2000/7', 'GET'), (None, None))
+
+	def test_route_arity(self):
+		"""Tests that a route works out once whether its handler wants the request."""
+
+		class Handler(object):
+			def view(self, request):
+				pass
+
+		self.assertFalse(tiny.TinyRoute('/', lambda: None).takes_request)
+		self.assertTrue(tiny.TinyRoute('/', Handler().view).takes_request)
+		self.assertFalse(tiny.TinyRoute('/<int:x>', lambda x: None).takes_request)
+		self.assertRaises(ValueError, tiny.TinyRoute, '/<path:p>/x', lambda p: None)
 
 class TestTinyRequest(unittest.TestCase):
 	"""Base class for testing TinyRequest."""
@@ -116,12 +300,996 @@ class TestTinyRequest(unittest.TestCase):
 	def test_get_data(self):
 		"""Tests that the data returned from a GET request is correctly parsed."""
 
-		# Test to go here when best approach is decided for making requests.
+		self.environ['QUERY_STRING'] = 'q=tiny+web&page=2&tag=a&tag=%C3%A9&blank='
+		get_data = self.request.get_data
+		self.assertEqual(get_data, {'q': 'tiny web', 'page': '2', 'tag': 'a'})
+		self.assertEqual(get_data.getall('tag'), ['a', u'\xe9' if str is not bytes else '\xc3\xa9'])
+		self.assertEqual(get_data.getall('missing'), [])
+
+	def test_headers_and_cookies(self):
+		"""Tests that headers and cookies are parsed lazily from the environ."""
+
+		self.environ.update({'HTTP_ACCEPT_ENCODING': 'gzip', 'CONTENT_TYPE': 'text/plain',
+							 'HTTP_COOKIE': 'session=abc; theme="dark"; session=def'})
+		self.assertEqual(self.request._headers, None)
+
+		self.assertEqual(self.request.headers['accept-encoding'], 'gzip')
+		self.assertEqual(self.request.headers.get('Content-Type'), 'text/plain')
+		self.assertTrue('Accept-Encoding' in self.request.headers)
+		self.assertEqual(self.request.cookies['theme'], 'dark')
+		self.assertEqual(self.request.cookies.getall('session'), ['abc', 'def'])
+		self.assertRaises(AttributeError, setattr, self.request, 'extra', 1)
+
+	def test_post_data_urlencoded(self):
+		"""Tests that an urlencoded body is parsed, even when split across chunks."""
+
+		class ChunkedRequest(tiny.TinyRequest):
+			chunk_size = 5
+
+		environ = create_post_environ('/index', b'name=tiny+app&tag=a&tag=b%26c&empty=', 'application/x-www-form-urlencoded')
+		post_data = ChunkedRequest(environ).post_data
+		self.assertEqual(post_data, {'name': 'tiny app', 'tag': 'a'})
+		self.assertEqual(post_data.getall('tag'), ['a', 'b&c'])
+
+	def test_post_data_multipart(self):
+		"""Tests that a multipart body is parsed into fields and uploads, and that
+		   large uploads are spilled to disk."""
+
+		body = (b'--XyZ\r\n'
+				b'Content-Disposition: form-data; name="title"\r\n\r\n'
+				b'Hello\r\n'
+				b'--XyZ\r\n'
+				b'Content-Disposition: form-data; name="upload"; filename="data.bin"\r\n'
+				b'Content-Type: application/octet-stream\r\n\r\n' +
+				b'\r\n--XY' * 3000 + b'\r\n'
+				b'--XyZ--\r\n')
+		class SpillingRequest(tiny.TinyRequest):
+			chunk_size = 1000
+			spill_size = 1024
+
+		post_data = SpillingRequest(create_post_environ('/index', body, 'multipart/form-data; boundary=XyZ')).post_data
+		self.assertEqual(post_data['title'], 'Hello')
+		upload = post_data['upload']
+		self.addCleanup(upload.file.close)
+		self.assertEqual((upload.filename, upload.content_type), ('data.bin', 'application/octet-stream'))
+		self.assertEqual(upload.read(), b'\r\n--XY' * 3000)
+		self.assertTrue(upload.file._rolled)
+
+	def test_post_data_multipart_utf8(self):
+		"""Tests that UTF-8 field and file names are decoded, and that names that
+		   aren't UTF-8 are read as latin-1."""
+
+		for encoding in ('utf-8', 'latin-1'):
+			body = (b'--XyZ\r\n'
+					b'Content-Disposition: form-data; name="' + u'r\xe9sum\xe9'.encode(encoding) + b'"; '
+					b'filename="' + u'caf\xe9.bin'.encode(encoding) + b'"\r\n\r\n'
+					b'data\r\n'
+					b'--XyZ--\r\n')
+			post_data = tiny.TinyRequest(create_post_environ('/index', body, 'multipart/form-data; boundary=XyZ')).post_data
+			name = u'r\xe9sum\xe9' if str is not bytes else u'r\xe9sum\xe9'.encode(encoding)
+			upload = post_data[name]
+			self.addCleanup(upload.file.close)
+			self.assertEqual(upload.filename, u'caf\xe9.bin' if str is not bytes else u'caf\xe9.bin'.encode(encoding))
+
+	def test_post_data_many_uploads(self):
+		"""Tests that uploads small enough to stay in memory are spilled to disk once
+		   together they go over max_memory_size."""
+
+		body = b''.join(b'--XyZ\r\n'
+						b'Content-Disposition: form-data; name="upload"; filename="%d.bin"\r\n\r\n' % i +
+						b'x' * 900 + b'\r\n' for i in range(10)) + b'--XyZ--\r\n'
+		class SmallMemoryRequest(tiny.TinyRequest):
+			spill_size = 1024
+			max_memory_size = 4096
+
+		uploads = SmallMemoryRequest(create_post_environ('/index', body, 'multipart/form-data; boundary=XyZ')).post_data.getall('upload')
+		for upload in uploads:
+			self.addCleanup(upload.file.close)
+		self.assertEqual([upload.read() for upload in uploads], [b'x' * 900] * 10)
+		self.assertTrue(sum(900 for upload in uploads if not upload.file._rolled) <= 4096)
+
+	def test_post_data_large_upload(self):
+		"""Tests that an upload larger than max_memory_size is accepted once it has
+		   spilled to disk, while field values still count toward the limit."""
+
+		body = (b'--XyZ\r\n'
+				b'Content-Disposition: form-data; name="upload"; filename="big.bin"\r\n\r\n' +
+				b'x' * 20000 + b'\r\n'
+				b'--XyZ--\r\n')
+		class SmallMemoryRequest(tiny.TinyRequest):
+			chunk_size = 1000
+			spill_size = 1024
+			max_memory_size = 4096
+
+		upload = SmallMemoryRequest(create_post_environ('/index', body, 'multipart/form-data; boundary=XyZ')).post_data['upload']
+		self.addCleanup(upload.file.close)
+		self.assertEqual(upload.read(), b'x' * 20000)
+		self.assertTrue(upload.file._rolled)
+
+		body = body.replace(b'; filename="big.bin"', b'')
+		request = SmallMemoryRequest(create_post_environ('/index', body, 'multipart/form-data; boundary=XyZ'))
+		self.assertRaises(tiny.TinyHTTPError, getattr, request, 'post_data')
+
+	def test_post_data_too_large(self):
+		"""Tests that a body over the request class's limit is answered with a 413."""
+
+		class LimitedRequest(tiny.TinyRequest):
+			max_body_size = 10
+
+		self.app.request_class = LimitedRequest
+		self.app.add_route('/index', lambda request: tiny.TinyResponse(str(request.post_data)), ['POST'])
+
+		environ = create_post_environ('/index', b'name=' + b'x' * 100, 'application/x-www-form-urlencoded')
+		response = self.app.request_handler(environ, lambda x, y: None)
+		self.assertEqual(response, [b'<a href="http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.14"><h1>413: Request Entity Too Large</h1></a>'])
 
 class TestTinyResponse(unittest.TestCase):
 	"""Base class for testing TinyResponse."""
 
-	# Tests to go here when best approach is decided for testing connecting to the app and making requests.
+	def test_response_body(self):
+		"""Tests that a string body is sent as a single encoded chunk with a length."""
+
+		response = tiny.TinyResponse(u'caf\xe9')
+		self.assertEqual(response.body, [b'caf\xc3\xa9'])
+		self.assertEqual(response.get_header('content-length'), '5')
+		self.assertEqual(response.status, '200 OK')
+
+	def test_response_headers_not_shared(self):
+		"""Tests that responses don't share a default headers list."""
+
+		first, second = tiny.TinyResponse('a'), tiny.TinyResponse('b')
+		first.set_header('X-Test', 'yes')
+		self.assertEqual(second.get_header('X-Test'), None)
+
+	def test_response_stream(self):
+		"""Tests that a generator body is streamed and closed, without a length."""
+
+		closed = []
+		def generate():
+			try:
+				yield u'one'
+				yield b'two'
+			finally:
+				closed.append(True)
+
+		response = tiny.TinyResponse(generate())
+		self.assertEqual(response.get_header('Content-Length'), None)
+		body = response.wsgi_body({})
+		self.assertEqual(next(body), b'one')
+		body.close()
+		self.assertEqual(closed, [True])
+
+	def test_response_from_file(self):
+		"""Tests that a file response uses the server's file wrapper if there is one."""
+
+		file_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, file_dir)
+		path = os.path.join(file_dir, 'data.txt')
+		with open(path, 'wb') as data_file:
+			data_file.write(b'x' * 100000)
+
+		response = tiny.TinyResponse.from_file(path)
+		self.assertEqual(response.get_header('Content-Type'), 'text/plain')
+		self.assertEqual(response.get_header('Content-Length'), '100000')
+		body = response.wsgi_body({})
+		self.assertEqual(b''.join(body), b'x' * 100000)
+		body.close()
+
+		response = tiny.TinyResponse.from_file(path)
+		wrapper = response.wsgi_body({'wsgi.file_wrapper': lambda file, block_size: ('wrapped', file)})
+		self.assertEqual(wrapper, ('wrapped', response.file))
+		response.file.close()
+
+	def test_json_response(self):
+		"""Tests that a JSON response is compact UTF-8 with a length, and that the
+		   serializer can be replaced."""
+
+		response = tiny.TinyJSONResponse({'name': u'caf\xe9', 'tags': [1, 2]}, 201)
+		self.assertEqual(response.status, '201 Created')
+		self.assertEqual(response.get_header('Content-Type'), 'application/json')
+		self.assertEqual(json.loads(b''.join(response.body).decode('utf-8')), {'name': u'caf\xe9', 'tags': [1, 2]})
+		self.assertFalse(b' ' in b''.join(response.body))
+		self.assertEqual(response.get_header('Content-Length'), str(len(b''.join(response.body))))
+		self.assertEqual(tiny.TinyJSONResponse({1: 'a'}).body, [b'{"1":"a"}'])
+
+		class SortedJSONResponse(tiny.TinyJSONResponse):
+			dumps = staticmethod(lambda value: json.dumps(value, sort_keys=True))
+
+		self.assertEqual(SortedJSONResponse({'b': 1, 'a': 2}).body, [b'{"a": 2, "b": 1}'])
+
+	def test_json_stream(self):
+		"""Tests that an iterable is streamed as a JSON array or NDJSON in batches,
+		   sending the first item on its own."""
+
+		class SmallBufferJSONResponse(tiny.TinyJSONResponse):
+			buffer_size = 20
+
+		closed = []
+		def rows():
+			try:
+				for i in range(10):
+					yield {'id': i}
+			finally:
+				closed.append(True)
+
+		response = SmallBufferJSONResponse.stream(rows())
+		self.assertEqual(response.get_header('Content-Type'), 'application/json')
+		self.assertEqual(response.get_header('Content-Length'), None)
+		chunks = list(response.wsgi_body({}))
+		self.assertEqual(chunks[0], b'[{"id":0}')
+		self.assertTrue(all(len(chunk) <= 30 for chunk in chunks))
+		self.assertEqual(json.loads(b''.join(chunks).decode('utf-8')), [{'id': i} for i in range(10)])
+		self.assertEqual(closed, [True])
+
+		response = tiny.TinyJSONResponse.stream(iter([{'id': 1}, {'id': 2}]), ndjson=True)
+		self.assertEqual(response.get_header('Content-Type'), 'application/x-ndjson')
+		self.assertEqual(b''.join(response.wsgi_body({})), b'{"id":1}\n{"id":2}\n')
+		self.assertEqual(b''.join(tiny.TinyJSONResponse.stream([]).wsgi_body({})), b'[]')
+
+class TestTinyStaticFiles(unittest.TestCase):
+	"""Base class for testing static files served with add_static."""
+
+	def setUp(self):
+		"""Creates an app serving a temporary directory at /static."""
+
+		self.directory = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.directory)
+		with open(os.path.join(self.directory, 'app.css'), 'wb') as css_file:
+			css_file.write(b'0123456789' * 10)
+		os.mkdir(os.path.join(self.directory, 'sub'))
+
+		self.app = tiny.TinyApp()
+		self.app.add_static('/static', self.directory, max_age=60)
+
+	def request(self, path, **headers):
+		"""Makes a request and returns (status, headers, body)."""
+
+		result = {}
+		def start_response(status, response_headers):
+			result.update(status=status, headers=dict(response_headers))
+
+		environ = create_environ(path, 'GET')
+		environ.update(headers)
+		body = self.app.request_handler(environ, start_response)
+		content = b''.join(body)
+		if hasattr(body, 'close'):
+			body.close()
+		return result['status'], result['headers'], content
+
+	def test_static_file(self):
+		"""Tests that a file is served with its length, type and validators."""
+
+		status, headers, body = self.request('/static/app.css')
+		self.assertEqual((status, body), ('200 OK', b'0123456789' * 10))
+		self.assertEqual(headers['Content-Length'], '100')
+		self.assertEqual(headers['Content-Type'], 'text/css; charset=utf-8')
+		self.assertEqual(headers['Cache-Control'], 'max-age=60')
+
+		status, headers, body = self.request('/static/app.css', HTTP_IF_NONE_MATCH=headers['ETag'])
+		self.assertEqual((status, body), ('304 Not Modified', b''))
+		status, headers, body = self.request('/static/app.css', HTTP_IF_MODIFIED_SINCE=headers['Last-Modified'])
+		self.assertEqual(status, '304 Not Modified')
+
+	def test_static_file_wrapper(self):
+		"""Tests that a whole file is handed to the server's wsgi.file_wrapper, while
+		   a range of it is sent by TinyFileWrapper."""
+
+		from wsgiref.util import FileWrapper
+
+		for range_header, wrapper in ((None, FileWrapper), ('bytes=10-19', tiny.TinyFileWrapper)):
+			environ = dict(create_environ('/static/app.css', 'GET'), **{'wsgi.file_wrapper': FileWrapper})
+			if range_header is not None:
+				environ['HTTP_RANGE'] = range_header
+			body = self.app.request_handler(environ, lambda status, headers: None)
+			self.assertTrue(isinstance(body, wrapper), range_header)
+			self.assertEqual(b''.join(body), b'0123456789' * (10 if range_header is None else 1))
+			body.close()
+
+	def test_static_file_not_found(self):
+		"""Tests that missing files, directories and paths outside the directory 404."""
+
+		for path in ('/static/missing.css', '/static/sub', '/static/../../../../../etc/passwd', '/static/sub/../../x'):
+			self.assertEqual(self.request(path)[0], '404 Not Found')
+
+	def test_static_file_range(self):
+		"""Tests that single byte ranges are answered with 206 or 416."""
+
+		status, headers, body = self.request('/static/app.css', HTTP_RANGE='bytes=10-19')
+		self.assertEqual((status, headers['Content-Range'], headers['Content-Length'], body), ('206 Partial Content', 'bytes 10-19/100', '10', b'0123456789'))
+
+		status, headers, body = self.request('/static/app.css', HTTP_RANGE='bytes=-5')
+		self.assertEqual((status, body), ('206 Partial Content', b'56789'))
+
+		status, headers, body = self.request('/static/app.css', HTTP_RANGE='bytes=100-')
+		self.assertEqual((status, headers['Content-Range']), ('416 Requested Range Not Satisfiable', 'bytes */100'))
+
+		status, headers, body = self.request('/static/app.css', HTTP_RANGE='bytes=10-19', HTTP_IF_RANGE='"stale"')
+		self.assertEqual((status, len(body)), ('200 OK', 100))
+
+class TestTinyCompressor(unittest.TestCase):
+	"""Base class for testing response compression."""
+
+	def setUp(self):
+		"""Creates an app that compresses its responses."""
+
+		self.app = tiny.TinyApp()
+		self.app.compressor = tiny.TinyCompressor(min_size=100)
+		self.app.add_route('/page', lambda: tiny.TinyResponse('<p>tiny</p>' * 100))
+		self.app.add_route('/small', lambda: tiny.TinyResponse('<p>tiny</p>'))
+		self.app.add_route('/stream', lambda: tiny.TinyResponse(('<p>%d</p>' % i for i in range(1000))))
+		self.app.add_route('/image', lambda: tiny.TinyResponse(b'\x89PNG' * 100, headers=[('Content-Type', 'image/png')]))
+		self.app.add_route('/cached', lambda: tiny.TinyResponse('<p>cached</p>' * 100), cache=tiny.TinyResponseCache())
+
+	def request(self, path, accept_encoding='gzip, deflate'):
+		"""Makes a request and returns (headers, body)."""
+
+		headers = {}
+		environ = dict(create_environ(path, 'GET'), HTTP_ACCEPT_ENCODING=accept_encoding)
+		body = b''.join(self.app.request_handler(environ, lambda status, response_headers: headers.update(response_headers)))
+		return headers, body
+
+	def test_compress_body(self):
+		"""Tests that a large text body is gzipped and a small one isn't."""
+
+		headers, body = self.request('/page')
+		self.assertEqual((headers['Content-Encoding'], headers['Vary']), ('gzip', 'Accept-Encoding'))
+		self.assertEqual(headers['Content-Length'], str(len(body)))
+		self.assertEqual(zlib.decompress(body, 16 + zlib.MAX_WBITS), b'<p>tiny</p>' * 100)
+
+		for path, accept_encoding in (('/small', 'gzip'), ('/image', 'gzip'), ('/page', 'identity'), ('/page', 'gzip;q=0')):
+			headers, body = self.request(path, accept_encoding)
+			self.assertFalse('Content-Encoding' in headers, (path, accept_encoding))
+
+	def test_compress_stream(self):
+		"""Tests that a streamed body is compressed chunk by chunk."""
+
+		headers, body = self.request('/stream')
+		self.assertEqual(headers['Content-Encoding'], 'gzip')
+		self.assertFalse('Content-Length' in headers)
+		self.assertEqual(zlib.decompress(body, 16 + zlib.MAX_WBITS), b''.join(b'<p>%d</p>' % i for i in range(1000)))
+
+	def test_compress_stream_with_length(self):
+		"""Tests that a streamed body's own Content-Length isn't sent with the
+		   compressed stream, and that its ETag is changed."""
+
+		self.app.add_route('/sized', lambda: tiny.TinyResponse(iter(['x' * 5000]), headers=[
+			('Content-Type', 'text/plain'), ('Content-Length', '5000'), ('ETag', '"sized"')]))
+		headers, body = self.request('/sized')
+		self.assertFalse('Content-Length' in headers)
+		self.assertEqual(headers['ETag'], '"sized-gzip"')
+		self.assertEqual(zlib.decompress(body, 16 + zlib.MAX_WBITS), b'x' * 5000)
+
+	def test_negotiate(self):
+		"""Tests that the accepted coding with the highest q is picked."""
+
+		compressor = self.app.compressor
+		self.assertEqual(compressor.negotiate('gzip;q=1, br;q=0.1'), 'gzip')
+		self.assertEqual(compressor.negotiate('gzip;q=0.5, br'), 'br' if tiny.brotli is not None else 'gzip')
+		self.assertEqual(compressor.negotiate('*;q=0.2'), 'br' if tiny.brotli is not None else 'gzip')
+		self.assertEqual(compressor.negotiate('deflate, gzip;q=0'), None)
+
+	def test_compress_weak_etag(self):
+		"""Tests that a body with a weak ETag is compressed but not cached."""
+
+		self.app.add_route('/weak', lambda: tiny.TinyResponse('<p>weak</p>' * 100, headers=[
+			('Content-Type', 'text/html'), ('ETag', 'W/"weak"')]))
+		headers, body = self.request('/weak')
+		self.assertEqual((headers['Content-Encoding'], headers['ETag']), ('gzip', 'W/"weak-gzip"'))
+		self.assertEqual(len(self.app.compressor.cache), 0)
+
+	def test_compress_cached(self):
+		"""Tests that a body with an ETag is compressed once, and that the client can
+		   revalidate with the compressed body's ETag."""
+
+		headers, body = self.request('/cached')
+		self.assertTrue(headers['ETag'].endswith('-gzip"'))
+		self.assertEqual(len(self.app.compressor.cache), 1)
+		self.assertEqual(self.request('/cached'), (headers, body))
+
+		status = []
+		environ = dict(create_environ('/cached', 'GET'), HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=headers['ETag'])
+		self.app.request_handler(environ, lambda response_status, response_headers: status.append(response_status))
+		self.assertEqual(status, ['304 Not Modified'])
+
+	def test_compress_static(self):
+		"""Tests that a static file is compressed whole, but a range of it isn't."""
+
+		self.app.add_static('/static', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+		headers, body = self.request('/static/README.md')
+		self.assertEqual(headers['Content-Encoding'], 'gzip')
+		with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'README.md'), 'rb') as f:
+			self.assertEqual(zlib.decompress(body, 16 + zlib.MAX_WBITS), f.read())
+
+		headers = {}
+		environ = dict(create_environ('/static/README.md', 'GET'), HTTP_ACCEPT_ENCODING='gzip', HTTP_RANGE='bytes=0-9')
+		body = b''.join(self.app.request_handler(environ, lambda status, response_headers: headers.update(response_headers)))
+		self.assertFalse('Content-Encoding' in headers)
+		self.assertEqual(len(body), 10)
+
+	def test_compress_static_same_etag(self):
+		"""Tests that static files with the same size and mtime, and so the same
+		   ETag, aren't served each other's compressed bodies."""
+
+		directory = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, directory)
+		for name in ('a.txt', 'b.txt'):
+			path = os.path.join(directory, name)
+			with open(path, 'wb') as f:
+				f.write(name.encode('ascii') * 1000)
+			os.utime(path, (1500000000, 1500000000))
+
+		self.app.add_static('/static', directory)
+		etags = set()
+		for name in ('a.txt', 'b.txt'):
+			headers, body = self.request('/static/' + name)
+			etags.add(headers['ETag'])
+			self.assertEqual(zlib.decompress(body, 16 + zlib.MAX_WBITS), name.encode('ascii') * 1000)
+		self.assertEqual(len(etags), 1)
+
+class TestTinyMetrics(unittest.TestCase):
+	"""Base class for testing hooks, metrics and the profiler."""
+
+	def setUp(self):
+		"""Creates an app with metrics on."""
+
+		self.app = tiny.TinyApp()
+		self.app.set_template_path('tiny/templates')
+		self.metrics = self.app.enable_metrics()
+		self.app.add_route('/page', lambda: tiny.TinyResponse(self.app.render('test_render.html', test_var='page')))
+		self.app.add_route('/form', lambda request: tiny.TinyResponse(request.post_data['name']), ['POST'])
+		self.app.add_route('/stream', lambda: tiny.TinyResponse(('%d' % i for i in range(10))))
+
+	def request(self, environ):
+		"""Makes a request and returns (status, body), closing the body like a server."""
+
+		status = []
+		result = self.app.request_handler(environ, lambda response_status, response_headers: status.append(response_status))
+		body = b''.join(result)
+		result.close()
+		return status[0], body
+
+	def test_hooks(self):
+		"""Tests that before hooks can answer a request, and after hooks can change
+		   the response, for the app and for a single route."""
+
+		calls = []
+		self.app.add_route('/private', lambda: tiny.TinyResponse('secret'),
+						   before=[lambda request: tiny.TinyResponse.error(403)],
+						   after=[lambda request, response: calls.append('route')])
+
+		@self.app.before_request
+		def before(request):
+			calls.append(request.path)
+
+		@self.app.after_request
+		def after(request, response):
+			response.set_header('X-Route', request.route.pattern if request.route else '')
+
+		self.assertEqual(self.request(create_environ('/private', 'GET'))[0], '403 Forbidden')
+		self.assertEqual(self.request(create_environ('/missing', 'GET'))[0], '404 Not Found')
+		self.assertEqual(calls, ['/private', 'route', '/missing'])
+
+		headers = {}
+		self.app.request_handler(create_environ('/page', 'GET'), lambda status, response_headers: headers.update(response_headers)).close()
+		self.assertEqual(headers['X-Route'], '/page')
+
+	def test_stage_timings(self):
+		"""Tests that each stage of a request is recorded in the route's histograms
+		   and that status codes are counted."""
+
+		self.request(create_environ('/page', 'GET'))
+		self.request(create_post_environ('/form', b'name=tiny', 'application/x-www-form-urlencoded'))
+		self.request(create_environ('/stream', 'GET'))
+		self.request(create_environ('/missing', 'GET'))
+
+		stages = dict((route, set(stage for (histogram_route, stage) in self.metrics.histograms if histogram_route == route))
+					  for route in ('/page', '/form', '/stream', ''))
+		self.assertEqual(stages['/page'], set(['routing', 'handler', 'render', 'write', 'total']))
+		self.assertEqual(stages['/form'], set(['routing', 'parse', 'handler', 'write', 'total']))
+		self.assertEqual(stages['/stream'], set(['routing', 'handler', 'write', 'total']))
+		self.assertEqual(self.metrics.histograms[('/page', 'total')].count, 1)
+		self.assertEqual(self.metrics.statuses, {('/page', 200): 1, ('/form', 200): 1, ('/stream', 200): 1, ('', 404): 1})
+
+	def test_server_file_wrapper(self):
+		"""Tests that a file sent with the server's wsgi.file_wrapper is handed back
+		   as that wrapper, so the server can still sendfile it, and is timed."""
+
+		from wsgiref.util import FileWrapper
+
+		readme = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'README.md')
+		self.app.add_route('/readme', lambda: tiny.TinyResponse.from_file(readme))
+		environ = dict(create_environ('/readme', 'GET'), **{'wsgi.file_wrapper': FileWrapper})
+		body = self.app.request_handler(environ, lambda status, headers: None)
+		self.assertTrue(isinstance(body, FileWrapper))
+		self.assertFalse(('/readme', 'write') in self.metrics.histograms)
+		body.close()
+		self.assertEqual(self.metrics.histograms[('/readme', 'write')].count, 1)
+
+	def test_metrics_route(self):
+		"""Tests that the metrics are served in the Prometheus text format."""
+
+		self.request(create_environ('/page', 'GET'))
+		status, body = self.request(create_environ('/metrics', 'GET'))
+		self.assertEqual(status, '200 OK')
+		self.assertTrue(b'tiny_request_duration_seconds_bucket{route="/page",stage="render",le="+Inf"} 1\n' in body)
+		self.assertTrue(b'tiny_request_duration_seconds_count{route="/page",stage="total"} 1\n' in body)
+		self.assertTrue(b'tiny_responses_total{route="/page",status="200"} 1\n' in body)
+
+	def test_profiler(self):
+		"""Tests that the profiler samples other threads' stacks while switched on."""
+
+		stop = threading.Event()
+		def busy_wait():
+			while not stop.is_set():
+				sum(range(100))
+
+		self.assertEqual(self.request(create_environ('/metrics/profile', 'GET'))[0], '404 Not Found')
+		self.app.add_route('/metrics/profile', self.metrics.profile_response)
+		thread = threading.Thread(target=busy_wait)
+		thread.start()
+		self.metrics.profiler.start()
+		try:
+			time.sleep(0.1)
+			status, body = self.request(create_environ('/metrics/profile', 'GET'))
+		finally:
+			self.metrics.profiler.stop()
+			stop.set()
+			thread.join()
+
+		self.assertFalse(self.metrics.profiler.running)
+		self.assertTrue(b'busy_wait (' in body)
+		self.assertTrue(body.splitlines()[0].split(b' ')[-1].isdigit())
+
+	def test_profile_one_at_a_time(self):
+		"""Tests that the profile route takes one on-demand sample at a time."""
+
+		self.metrics = self.app.enable_metrics(None, profile_path='/metrics/profile')
+		results = []
+		environ = create_environ('/metrics/profile', 'GET')
+		environ['QUERY_STRING'] = 'seconds=0.3'
+		sampling = threading.Thread(target=lambda: results.append(self.request(environ)))
+		sampling.start()
+		time.sleep(0.1)
+		self.assertEqual(self.request(create_environ('/metrics/profile', 'GET'))[0], '409 Conflict')
+		sampling.join()
+		self.assertEqual(results[0][0], '200 OK')
+
+		threads = threading.active_count()
+		for seconds in ('-1', '0', 'nan', 'inf', 'x'):
+			environ = dict(create_environ('/metrics/profile', 'GET'), QUERY_STRING='seconds=' + seconds)
+			self.assertEqual(self.request(environ)[0], '400 Bad Request', seconds)
+		self.assertEqual(threading.active_count(), threads)
+
+class TestTinyLimiter(unittest.TestCase):
+	"""Base class for testing admission control and deadlines."""
+
+	def setUp(self):
+		"""Creates an app whose /busy route runs until released."""
+
+		self.app = tiny.TinyApp()
+		self.release = threading.Event()
+		self.started = threading.Event()
+
+		def busy():
+			self.started.set()
+			self.release.wait(5)
+			return tiny.TinyResponse('done')
+
+		self.busy = busy
+
+	def request(self, environ):
+		"""Makes a request and returns (status, headers, body)."""
+
+		result = {}
+		def start_response(status, response_headers):
+			result.update(status=status, headers=dict(response_headers))
+
+		body = b''.join(self.app.request_handler(environ, start_response))
+		return result['status'], result['headers'], body
+
+	def test_limiter(self):
+		"""Tests that a limiter admits up to its limit, queues up to its queue size
+		   and turns away the rest."""
+
+		limiter = tiny.TinyLimiter(1, max_queue=1, queue_timeout=0.05)
+		self.assertTrue(limiter.acquire())
+		self.assertFalse(limiter.acquire())
+		self.assertEqual(limiter.rejected, 1)
+
+		admitted = []
+		limiter.queue_timeout = 5
+		waiter = threading.Thread(target=lambda: admitted.append(limiter.acquire()))
+		waiter.start()
+		while not limiter.waiting:
+			time.sleep(0.001)
+		self.assertFalse(limiter.acquire(blocking=False))
+		self.assertFalse(limiter.acquire())
+		limiter.release()
+		waiter.join()
+		self.assertEqual((admitted, limiter.active, limiter.waiting), ([True], 1, 0))
+
+	def test_limiter_enqueue(self):
+		"""Tests that places taken in the queue ahead of acquire count toward the
+		   limit and the queue timeout."""
+
+		limiter = tiny.TinyLimiter(1, max_queue=1, queue_timeout=0.05)
+		queued_at = tiny._monotonic()
+		self.assertTrue(limiter.enqueue())
+		self.assertTrue(limiter.enqueue())
+		self.assertFalse(limiter.enqueue())
+		self.assertFalse(limiter.acquire(blocking=False))
+		self.assertTrue(limiter.acquire(queued_at=queued_at))
+		limiter.dequeue()
+		self.assertEqual((limiter.active, limiter.waiting, limiter.rejected), (1, 0, 1))
+
+		limiter.release()
+		self.assertTrue(limiter.enqueue())
+		time.sleep(0.06)
+		self.assertFalse(limiter.acquire(queued_at=queued_at))
+		self.assertEqual((limiter.active, limiter.waiting, limiter.rejected), (0, 0, 2))
+
+	def test_load_shedding(self):
+		"""Tests that requests over an app's or a route's limit get a 503 with
+		   Retry-After, while other routes are still served."""
+
+		self.app.add_route('/busy', self.busy, limiter=tiny.TinyLimiter(1, retry_after=3))
+		self.app.add_route('/index', lambda: tiny.TinyResponse('index'))
+
+		results = []
+		thread = threading.Thread(target=lambda: results.append(self.request(create_environ('/busy', 'GET'))))
+		thread.start()
+		self.started.wait(5)
+		try:
+			status, headers, body = self.request(create_environ('/busy', 'GET'))
+			self.assertEqual((status, headers['Retry-After']), ('503 Service Unavailable', '3'))
+			self.assertEqual(self.request(create_environ('/index', 'GET'))[0], '200 OK')
+
+			self.app.limiter = tiny.TinyLimiter(1)
+			self.assertEqual(self.request(create_environ('/index', 'GET'))[0], '200 OK')
+		finally:
+			self.release.set()
+			thread.join()
+		self.assertEqual(results[0][2], b'done')
+		self.assertEqual((self.app.limiter.active, self.app.router.match('/busy', 'GET')[0].limiter.active), (0, 0))
+
+	def test_deadline(self):
+		"""Tests that a handler overrunning its route's timeout, or a request whose
+		   deadline passes while it is queued, gets a 504."""
+
+		self.release.set()
+		self.app.add_route('/slow', lambda request: time.sleep(0.1) or tiny.TinyResponse(str(request.expired)), timeout=0.05)
+		self.app.add_route('/fast', lambda request: tiny.TinyResponse('%.1f' % request.time_left()), timeout=10)
+		self.assertEqual(self.request(create_environ('/slow', 'GET'))[0], '504 Gateway Timeout')
+		self.assertEqual(self.request(create_environ('/fast', 'GET'))[2], b'10.0')
+
+		limiter = tiny.TinyLimiter(1, max_queue=1, queue_timeout=5)
+		self.app.add_route('/queued', lambda: tiny.TinyResponse('queued'), limiter=limiter, timeout=0.05)
+		limiter.acquire()
+		try:
+			self.assertEqual(self.request(create_environ('/queued', 'GET'))[0], '504 Gateway Timeout')
+		finally:
+			limiter.release()
+
+	def test_slow_body(self):
+		"""Tests that reading a request body past the route's deadline gets a 408."""
+
+		class SlowInput(object):
+			def read(self, size):
+				time.sleep(0.02)
+				return b'a' * size
+
+		class SmallChunkRequest(tiny.TinyRequest):
+			chunk_size = 4
+
+		self.app.request_class = SmallChunkRequest
+		self.app.add_route('/upload', lambda request: tiny.TinyResponse(request.post_data['name']), ['POST'], timeout=0.05)
+		environ = create_post_environ('/upload', b'', 'application/x-www-form-urlencoded')
+		environ.update({'CONTENT_LENGTH': '100', 'wsgi.input': SlowInput()})
+		self.assertEqual(self.request(environ)[0], '408 Request Timeout')
+
+	def test_http_error_headers(self):
+		"""Tests that headers raised with a TinyHTTPError are sent with the error."""
+
+		def handler():
+			raise tiny.TinyHTTPError(503, [('Retry-After', '10')])
+
+		self.app.add_route('/down', handler)
+		status, headers, body = self.request(create_environ('/down', 'GET'))
+		self.assertEqual((status, headers['Retry-After']), ('503 Service Unavailable', '10'))
+
+class TestTinyServer(unittest.TestCase):
+	"""Base class for testing the built-in tiny_server."""
+
+	def setUp(self):
+		"""Starts a TinyHTTPServer with a small thread pool on a free port."""
+
+		self.app = tiny.TinyApp()
+		self.app.add_route('/index', lambda: tiny.TinyResponse('test'))
+		self.app.add_route('/stream', lambda: tiny.TinyResponse(iter(['one', 'two'])))
+		self.app.add_route('/echo', lambda request: tiny.TinyResponse(request.post_data['text']), ['POST'])
+
+		self.server = tiny.TinyHTTPServer(self.app, tiny._listen('127.0.0.1', 0), threads=2, quiet=True)
+		thread = threading.Thread(target=self.server.serve_forever)
+		thread.daemon = True
+		thread.start()
+
+	def tearDown(self):
+		"""Stops the server."""
+
+		self.server.stop(timeout=5)
+
+	def test_keep_alive(self):
+		"""Tests that several requests, including a chunked response and a POST,
+		   are served over one HTTP/1.1 connection."""
+
+		connection = HTTPConnection('127.0.0.1', self.server.server_port, timeout=5)
+
+		connection.request('GET', '/index')
+		response = connection.getresponse()
+		self.assertEqual((response.status, response.getheader('Content-Length'), response.read()), (200, '4', b'test'))
+
+		connection.request('GET', '/stream')
+		response = connection.getresponse()
+		self.assertEqual((response.getheader('Transfer-Encoding'), response.read()), ('chunked', b'onetwo'))
+
+		connection.request('POST', '/echo', 'text=hi', {'Content-Type': 'application/x-www-form-urlencoded'})
+		response = connection.getresponse()
+		self.assertEqual(response.read(), b'hi')
+
+		connection.request('GET', '/missing')
+		self.assertEqual(connection.getresponse().status, 404)
+		connection.close()
+
+	def send_raw(self, data):
+		"""Sends raw bytes on a new connection and returns everything received
+		   until the server closes it."""
+
+		client = socket.create_connection(('127.0.0.1', self.server.server_port), timeout=5)
+		client.sendall(data)
+		received = b''
+		while True:
+			chunk = client.recv(65536)
+			if not chunk:
+				break
+			received += chunk
+		client.close()
+		return received
+
+	def test_bad_content_length(self):
+		"""Tests that a request with an invalid or conflicting Content-Length gets a
+		   400 and the connection is closed, so its body is never read as a request."""
+
+		self.app.add_route('/admin', lambda: tiny.TinyResponse('ADMIN'))
+		smuggled = b'GET /admin HTTP/1.1\r\nHost: x\r\n\r\n'
+		for lengths in ([b'1x'], [b'-1'], [b'5', b'6'], [b'5, 6']):
+			head = b''.join(b'Content-Length: ' + length + b'\r\n' for length in lengths)
+			received = self.send_raw(b'POST /echo HTTP/1.1\r\nHost: x\r\n' + head + b'\r\nhello' + smuggled)
+			self.assertTrue(received.startswith(b'HTTP/1.1 400 '), lengths)
+			self.assertEqual(received.count(b'HTTP/1.1 '), 1, lengths)
+			self.assertFalse(b'ADMIN' in received, lengths)
+
+		received = self.send_raw(b'POST /echo HTTP/1.1\r\nHost: x\r\nContent-Type: application/x-www-form-urlencoded\r\n'
+								 b'Content-Length: 7\r\nContent-Length: 7\r\nConnection: close\r\n\r\ntext=hi')
+		self.assertTrue(received.startswith(b'HTTP/1.1 200 ') and received.endswith(b'\r\n\r\nhi'))
+
+	def test_idle_connections_yield(self):
+		"""Tests that idle kept-alive connections give their threads up to a new
+		   connection rather than holding them until the keep-alive timeout."""
+
+		idle = []
+		for i in range(2):
+			connection = HTTPConnection('127.0.0.1', self.server.server_port, timeout=5)
+			connection.request('GET', '/index')
+			connection.getresponse().read()
+			idle.append(connection)
+		time.sleep(0.1)
+
+		started = time.time()
+		connection = HTTPConnection('127.0.0.1', self.server.server_port, timeout=5)
+		connection.request('GET', '/index')
+		self.assertEqual(connection.getresponse().read(), b'test')
+		self.assertTrue(time.time() - started < 1)
+		for connection in idle + [connection]:
+			connection.close()
+
+	def test_pipelined_requests(self):
+		"""Tests that a request already buffered behind the previous one is served."""
+
+		received = self.send_raw(b'GET /index HTTP/1.1\r\nHost: x\r\n\r\n'
+								 b'GET /index HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n')
+		self.assertEqual(received.count(b'HTTP/1.1 200 '), 2)
+
+@unittest.skipIf(sys.version_info < (3, 7), 'Serving with asyncio needs Python 3.7 or later.')
+class TestAsyncio(unittest.TestCase):
+	"""Base class for testing async handlers and the asyncio server."""
+
+	def setUp(self):
+		"""Creates an app with async and sync routes."""
+
+		import async_handlers
+
+		self.app = tiny.TinyApp()
+		self.app.add_route('/slow', async_handlers.slow)
+		self.app.add_route('/users/<int:user_id>', async_handlers.user)
+		self.app.add_route('/index', lambda: tiny.TinyResponse('test'))
+
+	def test_async_handler_sync_server(self):
+		"""Tests that an async handler also works behind a synchronous WSGI server."""
+
+		self.assertTrue(self.app.router.match('/users/7', 'GET')[0].is_async)
+		response = self.app.request_handler(create_environ('/users/7', 'GET'), lambda x, y: None)
+		self.assertEqual(response, [b'user 7'])
+
+	def test_async_deadline(self):
+		"""Tests that an async handler is cancelled with a 504 when its route's
+		   deadline passes."""
+
+		import asyncio, async_handlers
+		from tiny import aio
+
+		self.app.add_route('/deadline', async_handlers.slow, timeout=0.05)
+		loop = asyncio.new_event_loop()
+		self.addCleanup(loop.close)
+		request = self.app.request_class(create_environ('/deadline', 'GET'))
+		started = time.time()
+		response = loop.run_until_complete(aio.handle_async(self.app, request))
+		self.assertEqual(response.status, '504 Gateway Timeout')
+		self.assertTrue(time.time() - started < 0.15)
+
+	def test_async_hook_http_errors(self):
+		"""Tests that an HTTP error raised by a before hook of an async route is
+		   answered with its error response."""
+
+		import asyncio, async_handlers
+		from tiny import aio
+
+		class LimitedRequest(tiny.TinyRequest):
+			max_body_size = 10
+
+		self.app.add_route('/csrf/<int:user_id>', async_handlers.user, ['POST'],
+						   before=[lambda request: request.post_data.get('token') and None])
+		loop = asyncio.new_event_loop()
+		self.addCleanup(loop.close)
+		request = LimitedRequest(create_post_environ('/csrf/7', b'token=' + b'x' * 100, 'application/x-www-form-urlencoded'))
+		response = loop.run_until_complete(aio.handle_async(self.app, request))
+		self.assertEqual(response.status, '413 Request Entity Too Large')
+
+	def start_server(self, threads=2):
+		"""Serves the app with the asyncio server on a background loop until the
+		   test ends, and returns the port."""
+
+		import asyncio
+		from tiny import aio
+
+		loop = asyncio.new_event_loop()
+		server = loop.run_until_complete(aio.start_server(self.app, '127.0.0.1', 0, threads=threads))
+		thread = threading.Thread(target=loop.run_forever)
+		thread.daemon = True
+		thread.start()
+
+		def stop():
+			loop.call_soon_threadsafe(loop.stop)
+			thread.join()
+			server.close()
+			tasks = asyncio.all_tasks(loop)
+			for task in tasks:
+				task.cancel()
+			if tasks:
+				loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+			loop.close()
+		self.addCleanup(stop)
+		return server.sockets[0].getsockname()[1]
+
+	def test_asyncio_server_errors(self):
+		"""Tests that errors raised by handlers and hooks are answered, not dropped."""
+
+		import async_handlers
+
+		def sync_boom():
+			raise ValueError('boom')
+
+		def check_auth(request):
+			if request.path == '/private':
+				raise tiny.TinyHTTPError(401)
+
+		self.app.add_route('/boom', async_handlers.boom)
+		self.app.add_route('/sync-boom', sync_boom)
+		self.app.add_route('/private', lambda: tiny.TinyResponse('secret'))
+		self.app.before_request(check_auth)
+		port = self.start_server()
+
+		stderr, sys.stderr = sys.stderr, io.StringIO()
+		try:
+			for path, status in (('/boom', 500), ('/sync-boom', 500), ('/private', 401), ('/index', 200)):
+				connection = HTTPConnection('127.0.0.1', port, timeout=5)
+				connection.request('GET', path)
+				response = connection.getresponse()
+				self.assertEqual(response.status, status, path)
+				self.assertTrue(response.read())
+				connection.close()
+		finally:
+			sys.stderr = stderr
+
+	def test_asyncio_server_load_shedding(self):
+		"""Tests that requests for a sync handler waiting for a pool thread count
+		   toward the limiter's queue, so the overflow gets a 503 at once."""
+
+		def busy():
+			time.sleep(0.5)
+			return tiny.TinyResponse('done')
+
+		self.app.limiter = tiny.TinyLimiter(2, max_queue=0)
+		self.app.add_route('/busy', busy, timeout=1.0)
+		port = self.start_server(threads=2)
+
+		results = []
+		def fetch():
+			connection = HTTPConnection('127.0.0.1', port, timeout=5)
+			started = time.time()
+			connection.request('GET', '/busy')
+			response = connection.getresponse()
+			response.read()
+			results.append((response.status, time.time() - started))
+			connection.close()
+
+		clients = [threading.Thread(target=fetch) for i in range(10)]
+		for client in clients:
+			client.start()
+		for client in clients:
+			client.join()
+
+		self.assertEqual(sorted(status for status, elapsed in results), [200] * 2 + [503] * 8)
+		self.assertTrue(all(elapsed < 0.25 for status, elapsed in results if status == 503))
+		self.assertTrue(all(elapsed < 0.9 for status, elapsed in results))
+		self.assertEqual((self.app.limiter.active, self.app.limiter.waiting), (0, 0))
+
+	def test_asyncio_server_body(self):
+		"""Tests that a large request body is spilled to disk rather than held in
+		   memory, and that bodies over the server's default limit are refused."""
+
+		from tiny import aio
+
+		class SpillingRequest(tiny.TinyRequest):
+			spill_size = 1024
+
+		self.app.request_class = SpillingRequest
+		self.app.add_route('/upload', lambda request: tiny.TinyResponse('%s %d' % (
+			request.environ['wsgi.input']._rolled, len(request.post_data['text']))), ['POST'])
+		self.addCleanup(setattr, aio.TinyConnection, 'max_body_size', aio.TinyConnection.max_body_size)
+		aio.TinyConnection.max_body_size = 10000
+		port = self.start_server()
+
+		for size, expected in ((5000, (200, b'True 5000')), (20000, (413, None))):
+			connection = HTTPConnection('127.0.0.1', port, timeout=5)
+			connection.request('POST', '/upload', 'text=' + 'x' * size, {'Content-Type': 'application/x-www-form-urlencoded'})
+			response = connection.getresponse()
+			body = response.read()
+			self.assertEqual((response.status, body if expected[1] else None), expected)
+			connection.close()
+
+	def test_asyncio_server_concurrency(self):
+		"""Tests that slow async handlers are served concurrently, beyond the size of
+		   the thread pool, next to sync handlers."""
+
+		port = self.start_server()
+
+		results = []
+		def fetch(path):
+			connection = HTTPConnection('127.0.0.1', port, timeout=5)
+			connection.request('GET', path)
+			results.append(connection.getresponse().read())
+			connection.close()
+
+		started = time.time()
+		clients = [threading.Thread(target=fetch, args=('/slow?n=%d' % i,)) for i in range(20)]
+		clients.append(threading.Thread(target=fetch, args=('/index',)))
+		for client in clients:
+			client.start()
+		for client in clients:
+			client.join()
+
+		self.assertTrue(time.time() - started < 2)
+		self.assertEqual(sorted(results), sorted([b'slow %d' % i for i in range(20)] + [b'test']))
 
 def create_environ(path, method):
 	"""Helper method that creates an environment to be used for request handler tests."""
@@ -129,5 +1297,12 @@ def create_environ(path, method):
 	environ = {'PATH_INFO': path, 'REQUEST_METHOD': method}
 	return environ
 
+def create_post_environ(path, body, content_type):
+	"""Helper method that creates an environment for a POST request with a body."""
+
+	environ = create_environ(path, 'POST')
+	environ.update({'CONTENT_TYPE': content_type, 'CONTENT_LENGTH': str(len(body)), 'wsgi.input': io.BytesIO(body)})
+	return environ
+
 if __name__ == "__main__":
 	unittest.main()
\ No newline at end of file
@@ -1 +1 @@
-import tiny
\ No newline at end of file
+from . import tiny
\ No newline at end of file
@@ -0,0 +1,357 @@
+"""
+aio.py serves a TinyApp on an asyncio event loop, so one process can hold
+many slow connections at once. Needs Python 3.7 or later.
+"""
+
+# asyncio for the event loop; concurrent.futures for the pool that runs sync handlers;
+# email.utils for the Date header; tempfile for request bodies; urllib for decoding paths.
+import asyncio, concurrent.futures, email.utils, sys, tempfile, traceback
+from urllib.parse import unquote
+
+from .tiny import HTTP_CODES, TinyFileWrapper, TinyHTTPError, TinyResponse, TinyTimings, _content_length_pattern, _monotonic
+
+async def start_server(app, host='', port=8080, threads=32, keepalive_timeout=5):
+	"""Starts serving the app on the running event loop and returns the
+	   asyncio server."""
+
+	executor = concurrent.futures.ThreadPoolExecutor(threads)
+
+	async def client_connected(reader, writer):
+		await TinyConnection(app, executor, reader, writer, keepalive_timeout).serve()
+
+	return await asyncio.start_server(client_connected, host or None, port)
+
+async def serve(app, host='', port=8080, threads=32, keepalive_timeout=5):
+	"""Serves the app on the running event loop until cancelled."""
+
+	server = await start_server(app, host, port, threads, keepalive_timeout)
+	async with server:
+		await server.serve_forever()
+
+async def handle_async(app, request, executor=None):
+	"""The asyncio counterpart of TinyApp.handle. async def handlers are awaited
+	   on the loop; everything else, including 404s and 405s, goes to the
+	   thread pool so it can't block the loop. Time spent rendering in an async
+	   handler is counted as handler time."""
+
+	loop = asyncio.get_running_loop()
+	route, params = app.router.match(request.path, request.method)
+
+	if route is None or request.method not in route.methods:
+		return await loop.run_in_executor(executor, app.handle, request)
+
+	request.route = route
+	if route.timeout is not None:
+		request.deadline = _monotonic() + route.timeout
+	timings = request.timings
+	if timings is not None:
+		timings.mark('routing')
+	try:
+		if not route.is_async:
+			return await handle_in_pool(app, request, route, params, executor)
+		return await dispatch_async(app, request, route, params, executor)
+	finally:
+		if timings is not None:
+			timings.mark('handler')
+
+async def dispatch_async(app, request, route, params, executor=None):
+	"""The asyncio counterpart of TinyApp.dispatch, for a route that matched."""
+
+	try:
+		response = app.run_before_hooks(request, route)
+		if response is not None:
+			return response
+
+		request.params = params
+
+		cache = route.cache
+		if cache is not None:
+			response = cache.lookup(request)
+			if response is not None:
+				return response
+
+		if app.limiter is None and route.limiter is None:
+			response = await call_async(request, route, params)
+		else:
+			response = await call_limited_async(app, request, route, params, executor)
+
+		if cache is not None:
+			response = cache.store(request, response)
+		return response
+	except TinyHTTPError as error:
+		return TinyResponse.error(error.status_code, error.headers)
+
+async def handle_in_pool(app, request, route, params, executor=None):
+	"""Hands a request for a sync handler to the thread pool. Its place in the
+	   limiters' queues is taken on the loop first, so a request waiting for a
+	   pool thread counts toward max_queue and queue_timeout, and one that
+	   doesn't fit is turned away at once instead of joining the pool's
+	   unbounded backlog."""
+
+	loop = asyncio.get_running_loop()
+	limiters = [limiter for limiter in (app.limiter, route.limiter) if limiter is not None]
+	if not limiters:
+		return await loop.run_in_executor(executor, app.handle_matched, request, route, params)
+
+	queued_at = _monotonic()
+	queued = []
+	for limiter in limiters:
+		if not limiter.enqueue():
+			for other in queued:
+				other.dequeue()
+			return limiter.reject()
+		queued.append(limiter)
+
+	# Shielded so a cancelled request still gives its places back once a thread picks it up.
+	return await asyncio.shield(loop.run_in_executor(executor, call_queued, app, request, route, params, queued, queued_at))
+
+def call_queued(app, request, route, params, queued, queued_at):
+	"""Runs in the thread pool for handle_in_pool: trades the request's places in
+	   the queues for slots, then handles it."""
+
+	acquired = []
+	try:
+		for index, limiter in enumerate(queued):
+			if not limiter.acquire(request.deadline, queued_at=queued_at):
+				for other in queued[index + 1:]:
+					other.dequeue()
+				return TinyResponse.error(504) if request.expired else limiter.reject()
+			acquired.append(limiter)
+		return app.handle_matched(request, route, params, admitted=True)
+	finally:
+		for limiter in acquired:
+			limiter.release()
+
+async def call_limited_async(app, request, route, params, executor=None):
+	"""The asyncio counterpart of TinyApp.call_limited. Only a request that has
+	   to queue for a slot waits in the thread pool."""
+
+	loop = asyncio.get_running_loop()
+	acquired = []
+	try:
+		for limiter in (app.limiter, route.limiter):
+			if limiter is None:
+				continue
+			if not limiter.acquire(request.deadline, blocking=False):
+				if not await loop.run_in_executor(executor, limiter.acquire, request.deadline):
+					return TinyResponse.error(504) if request.expired else limiter.reject()
+			acquired.append(limiter)
+		return await call_async(request, route, params)
+	finally:
+		for limiter in acquired:
+			limiter.release()
+
+async def call_async(request, route, params):
+	"""The asyncio counterpart of TinyApp.call. The handler is cancelled when
+	   the deadline passes."""
+
+	if request.expired:
+		return TinyResponse.error(504)
+
+	try:
+		if request.deadline is None:
+			return await route.call(request, params)
+		return await asyncio.wait_for(route.call(request, params), request.time_left())
+	except asyncio.TimeoutError:
+		return TinyResponse.error(504)
+	except TinyHTTPError as error:
+		return TinyResponse.error(error.status_code, error.headers)
+
+class TinyConnection(object):
+	"""Speaks HTTP/1.1 to one client connection on the event loop, keeping it
+	   alive between requests like TinyRequestHandler does."""
+
+	# Request bodies are read before the handler runs, so they are refused over
+	# this size unless the app's request class sets its own max_body_size.
+	max_body_size = 100 * 1024 * 1024
+
+	def __init__(self, app, executor, reader, writer, keepalive_timeout=5):
+		"""Binds the app, the thread pool and the connection's streams."""
+
+		self.app = app
+		self.executor = executor
+		self.reader = reader
+		self.writer = writer
+		self.keepalive_timeout = keepalive_timeout
+
+	async def serve(self):
+		"""Answers requests until the connection should be closed."""
+
+		try:
+			while await self.serve_one():
+				pass
+		except (ConnectionError, asyncio.IncompleteReadError):
+			pass
+		except Exception:
+			traceback.print_exc()
+		finally:
+			self.writer.close()
+
+	async def serve_one(self):
+		"""Reads and answers one request. Returns whether to keep the connection."""
+
+		try:
+			head = await asyncio.wait_for(self.reader.readuntil(b'\r\n\r\n'), self.keepalive_timeout)
+		except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+			return False
+
+		lines = head.decode('latin-1').split('\r\n')
+		try:
+			method, target, version = lines[0].split(' ')
+		except ValueError:
+			await self.send_error(400, 'HTTP/1.0')
+			return False
+
+		path, _, query = target.partition('?')
+		environ = {
+			'REQUEST_METHOD': method,
+			'SCRIPT_NAME': '',
+			'PATH_INFO': unquote(path, 'latin-1'),
+			'QUERY_STRING': query,
+			'SERVER_PROTOCOL': version,
+			'wsgi.version': (1, 0),
+			'wsgi.url_scheme': 'http',
+			'wsgi.errors': sys.stderr,
+			'wsgi.multithread': True,
+			'wsgi.multiprocess': False,
+			'wsgi.run_once': False,
+		}
+		peer = self.writer.get_extra_info('peername')
+		if peer:
+			environ['REMOTE_ADDR'] = peer[0]
+
+		for line in lines[1:]:
+			if not line:
+				continue
+			name, _, value = line.partition(':')
+			key = name.strip().upper().replace('-', '_')
+			if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+				key = 'HTTP_' + key
+			value = value.strip()
+			environ[key] = environ[key] + ',' + value if key in environ else value
+
+		connection = environ.get('HTTP_CONNECTION', '').lower()
+		keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+
+		if 'chunked' in environ.get('HTTP_TRANSFER_ENCODING', '').lower():
+			await self.send_error(411, version)
+			return False
+
+		# The body is read up front so sync handlers never wait on the network
+		# from the thread pool.
+		content_length = environ.get('CONTENT_LENGTH') or '0'
+		if not _content_length_pattern.match(content_length):
+			await self.send_error(400, version)
+			return False
+		length = int(content_length)
+
+		request_class = self.app.request_class
+		max_body_size = request_class.max_body_size
+		if max_body_size is None:
+			max_body_size = self.max_body_size
+		if length > max_body_size:
+			await self.send_error(413, version)
+			return False
+		environ['wsgi.input'] = await self.read_body(length, request_class.spill_size, request_class.chunk_size)
+
+		request = self.app.request_class(environ)
+		metrics = self.app.metrics
+		if metrics is not None:
+			request.timings = TinyTimings()
+
+		try:
+			response = await handle_async(self.app, request, self.executor)
+			route = request.route
+			if self.app.compressor is not None or self.app.after_hooks or route is not None and route.after:
+				# Compressing and hooks can take a while, so they run in the pool too.
+				response = await asyncio.get_running_loop().run_in_executor(self.executor, self.app.finish, request, response)
+			else:
+				response = self.app.finish(request, response)
+		except TinyHTTPError as error:
+			response = TinyResponse.error(error.status_code, error.headers)
+		except Exception:
+			# Answer like the threaded server does, as nothing has been sent yet.
+			traceback.print_exc()
+			response = TinyResponse.error(500)
+			keep_alive = False
+
+		body = response.wsgi_body(environ)
+		if metrics is not None:
+			body = metrics.record(request, response, body)
+		try:
+			return await self.send(response, body, environ, version, keep_alive)
+		finally:
+			environ['wsgi.input'].close()
+
+	async def read_body(self, length, spill_size, chunk_size):
+		"""Reads a request body in chunks into a file that moves to disk once it
+		   grows past spill_size, so large bodies don't sit in memory."""
+
+		body = tempfile.SpooledTemporaryFile(max_size=spill_size)
+		remaining = length
+		while remaining > 0:
+			chunk = await self.reader.readexactly(min(chunk_size, remaining))
+			body.write(chunk)
+			remaining -= len(chunk)
+		body.seek(0)
+		return body
+
+	async def send(self, response, body, environ, version, keep_alive):
+		"""Writes a response, streaming bodies without a length as chunks.
+		   Returns whether the connection can be kept alive."""
+
+		loop = asyncio.get_running_loop()
+		is_head = environ['REQUEST_METHOD'] == 'HEAD'
+		chunked = False
+
+		headers = list(response.headers)
+		has_length = any(name.lower() == 'content-length' for name, value in headers)
+		if not has_length and response.status_code >= 200 and response.status_code not in (204, 304) and not is_head:
+			if version == 'HTTP/1.1':
+				chunked = True
+				headers.append(('Transfer-Encoding', 'chunked'))
+			else:
+				keep_alive = False
+		if not keep_alive:
+			headers.append(('Connection', 'close'))
+		headers.append(('Date', email.utils.formatdate(usegmt=True)))
+
+		head = ['%s %s\r\n' % (version, response.status)]
+		head.extend('%s: %s\r\n' % header for header in headers)
+		head.append('\r\n')
+		self.writer.write(''.join(head).encode('latin-1'))
+
+		try:
+			if is_head:
+				pass
+			elif isinstance(body, TinyFileWrapper) and has_length:
+				await self.writer.drain()
+				length = int(response.get_header('Content-Length'))
+				await loop.sendfile(self.writer.transport, body.file, body.file.tell(), length)
+			elif isinstance(body, list):
+				self.writer.write(b''.join(body))
+			else:
+				# Streamed bodies may block, so they are advanced in the pool.
+				chunks = iter(body)
+				while True:
+					chunk = await loop.run_in_executor(self.executor, next, chunks, None)
+					if chunk is None:
+						break
+					if chunk:
+						self.writer.write(b'%x\r\n%s\r\n' % (len(chunk), chunk) if chunked else chunk)
+						await self.writer.drain()
+			if chunked and not is_head:
+				self.writer.write(b'0\r\n\r\n')
+			await self.writer.drain()
+		finally:
+			if hasattr(body, 'close'):
+				body.close()
+		return keep_alive
+
+	async def send_error(self, status_code, version):
+		"""Writes an error response and closes the connection."""
+
+		body = TinyResponse.error(status_code).body[0]
+		self.writer.write(('%s %s %s\r\nContent-Type: text/html; charset=utf-8\r\nContent-Length: %d\r\nConnection: close\r\n\r\n'
+						   % (version, status_code, HTTP_CODES[status_code][0], len(body))).encode('latin-1') + body)
+		await self.writer.drain()
\ No newline at end of file
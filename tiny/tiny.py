@@ -3,8 +3,61 @@ tiny.py is a practice project that implements the
 most basic possible web framework in Python.
 """
 
-# cgi used for form parsing; inspect for argument counting for routing; os for template directory; re for template rendering.
-import cgi, inspect, os, re
+# inspect for argument counting for routing; os for template directory; re for template rendering.
+# io for reading templates; threading for guarding shared caches; collections for LRU ordering.
+# tempfile for spilling large uploads to disk; sys for telling Python 2 and 3 apart; mimetypes for file responses.
+# errno, signal, socket, time and traceback for the built-in server; hashlib for ETags.
+# stat and email.utils for static files; bisect for metrics histograms; zlib (and brotli, if installed) for compression.
+# json for JSON responses.
+import bisect, collections, email.utils, errno, hashlib, inspect, io, json, mimetypes, os, re, select, signal, socket, stat, sys, tempfile, threading, time, traceback, zlib
+
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+try:
+	from collections.abc import Mapping
+	from http.server import BaseHTTPRequestHandler, HTTPServer
+	from queue import Queue
+	from urllib.parse import unquote, unquote_plus
+except ImportError:
+	from collections import Mapping
+	from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+	from Queue import Queue
+	from urllib import unquote, unquote_plus
+
+PY2 = sys.version_info[0] == 2
+_text_type = type(u'')
+
+# Python 2 has no coroutines, so nothing there is ever async.
+_iscoroutinefunction = getattr(inspect, 'iscoroutinefunction', lambda function: False)
+_isawaitable = getattr(inspect, 'isawaitable', lambda value: False)
+_event_loops = threading.local()
+_current_timings = threading.local()
+_monotonic = getattr(time, 'monotonic', time.time)
+
+def _to_native(data):
+	"""Turns raw bytes from the request into the native str type. Percent-escapes
+	   are left for unquote_plus, which decodes them as UTF-8 on Python 3."""
+
+	return data if PY2 else data.decode('latin-1')
+
+def _to_text(data):
+	"""Turns raw bytes from the request into text (a str on Python 2)."""
+
+	return data if PY2 else data.decode('utf-8', 'replace')
+
+def _run_coroutine(coroutine):
+	"""Runs an async handler's coroutine to completion when the app is served
+	   by a synchronous server. Each thread keeps its own event loop for this."""
+
+	import asyncio
+
+	loop = getattr(_event_loops, 'loop', None)
+	if loop is None:
+		loop = _event_loops.loop = asyncio.new_event_loop()
+	return loop.run_until_complete(coroutine)
 
 class TinyApp(object):
 	"""Represents an app created by the user.
@@ -15,12 +68,46 @@ class TinyApp(object):
 		"""Initializes the app object with an empty dict of routes."""
 
 		self.routes = {}
+		self.router = TinyRouter()
+
+		# Subclass TinyRequest to change request body limits for this app.
+		self.request_class = TinyRequest
+
+		# Compiled templates keyed by file path: (mtime, TinyTemplate).
+		self.templates = TinyLRUCache(128)
+		self.template_auto_reload = True
+
+		# Set to a TinyCompressor to compress responses.
+		self.compressor = None
+
+		# Functions called before and after every request; see before_request.
+		self.before_hooks = []
+		self.after_hooks = []
+
+		# Set by enable_metrics to a TinyMetrics that times every request.
+		self.metrics = None
 
-	def add_route(self, route, handler, methods=['GET']):
-		"""Adds a function to the app's routing dict.
-		   Handler - function defined by the user that creates a response."""
+		# Set to a TinyLimiter to limit how many handlers run at once across the app.
+		self.limiter = None
+
+	def add_route(self, route, handler, methods=['GET'], cache=None, before=None, after=None, limiter=None, timeout=None):
+		"""Adds a function to the app's routing dict and compiles it into the router.
+		   Handler - function defined by the user that creates a response.
+		   Routes can hold typed path parameters, e.g. '/users/<int:user_id>',
+		   which are passed to the handler as keyword arguments.
+		   Cache - optional TinyResponseCache for the route's GET responses.
+		   Before, after - optional lists of hooks for this route only.
+		   Limiter - optional TinyLimiter for this route's handler.
+		   Timeout - optional deadline for the route's requests, in seconds."""
 
 		self.routes[route] = (handler, methods)
+		self.router.add(TinyRoute(route, handler, methods, cache, before, after, limiter, timeout))
+
+	def add_static(self, prefix, directory, max_age=None):
+		"""Serves the files under a directory at a URL prefix, e.g.
+		   app.add_static('/static', '/srv/app/static')."""
+
+		self.add_route(prefix.rstrip('/') + '/<path:filename>', TinyStaticFiles(directory, max_age), ['GET', 'HEAD'])
 
 	def route(self, route, **kwargs):
 		"""Decorator for add_route."""
@@ -30,6 +117,35 @@ class TinyApp(object):
 			return handler
 		return wrapper
 
+	def before_request(self, hook):
+		"""Decorator that registers a function to call with every request before
+		   its handler. If the function returns a response, the handler is skipped
+		   and that response is sent instead."""
+
+		self.before_hooks.append(hook)
+		return hook
+
+	def after_request(self, hook):
+		"""Decorator that registers a function to call with every request and its
+		   response before the response is sent. The function may return a
+		   new response to send instead."""
+
+		self.after_hooks.append(hook)
+		return hook
+
+	def enable_metrics(self, path='/metrics', buckets=None, profile_path=None):
+		"""Times every request and counts its status codes with a TinyMetrics,
+		   which is returned. The metrics are served as text at the path, unless
+		   the path is None. The profile route ties up a thread while it samples
+		   and shows source paths, so it is only served if a profile_path is given."""
+
+		self.metrics = TinyMetrics(buckets)
+		if path is not None:
+			self.add_route(path, self.metrics.response)
+		if profile_path is not None:
+			self.add_route(profile_path, self.metrics.profile_response)
+		return self.metrics
+
 	### Request Handler ###
 
 	def request_handler(self, environ, start_response):
@@ -38,44 +154,208 @@ class TinyApp(object):
 		   a response and send it back to the server using the start_response
 		   function, which is provided by the server."""
 
-		request = TinyRequest(environ)
-		action_fun, action_methods = self.routes.get(request.path, (None, None)) 
+		request = self.request_class(environ)
+		metrics = self.metrics
+		if metrics is not None:
+			request.timings = TinyTimings()
 
-		# TODO: Move this into its own function/method.
-		# FIXME: Request handling is failing on multiple subsequent requests of different types.
-		if not action_fun:
-			response = TinyResponse.error(404)
-		elif request.method not in action_methods:
-			response = TinyResponse.error(405)
-		else:
-			arg_num = len(inspect.getargspec(action_fun)[0])
+		response = self.finish(request, self.handle(request))
+
+		start_response(response.status, response.headers)
+		if metrics is not None:
+			return metrics.record(request, response, response.wsgi_body(environ))
+		return response.wsgi_body(environ)
+
+	def finish(self, request, response):
+		"""Applies the stages every response goes through before it is sent:
+		   the after hooks, then compression."""
+
+		route = request.route
+		try:
+			if route is not None and route.after and request.method in route.methods:
+				response = _run_after_hooks(route.after, request, response)
+			if self.after_hooks:
+				response = _run_after_hooks(self.after_hooks, request, response)
+		except TinyHTTPError as error:
+			response.close()
+			response = TinyResponse.error(error.status_code, error.headers)
+
+		if self.compressor is not None:
+			response = self.compressor.compress(request, response)
+		return response
+
+	def handle(self, request):
+		"""Matches a request against the router and returns the response of the
+		   matching handler, or an error response if no route fits. The routing
+		   and handler stages are timed if metrics are on."""
 
-			# If there aren't any arguments, don't pass the get_data dict to it.
-			if arg_num == 0:
-				response = action_fun()
+		route, params = self.router.match(request.path, request.method)
+		request.route = route
+		if route is not None and route.timeout is not None:
+			request.deadline = _monotonic() + route.timeout
+
+		if request.timings is not None:
+			request.timings.mark('routing')
+		return self.handle_matched(request, route, params)
+
+	def handle_matched(self, request, route, params, admitted=False):
+		"""The part of handle after routing. Pass admitted if the app's and the
+		   route's limiters have already let the request in."""
+
+		timings = request.timings
+		if timings is None:
+			return self.dispatch(request, route, params, admitted)
+
+		# Lets render charge its time to the request being handled on this thread.
+		_current_timings.timings = timings
+		try:
+			return self.dispatch(request, route, params, admitted)
+		finally:
+			_current_timings.timings = None
+			timings.mark('handler')
+
+	def run_before_hooks(self, request, route):
+		"""Calls the app's before hooks, then the route's. Returns the first
+		   response a hook returns, or None."""
+
+		for hook in self.before_hooks:
+			response = hook(request)
+			if response is not None:
+				return response
+
+		if route is not None and request.method in route.methods:
+			for hook in route.before:
+				response = hook(request)
+				if response is not None:
+					return response
+		return None
+
+	def dispatch(self, request, route, params, admitted=False):
+		"""Returns the response for a matched (or unmatched) route: runs the
+		   before hooks, checks the route's cache and calls its handler, through
+		   the limiters unless the request was already admitted."""
+
+		# Hooks and cache keys may parse the body too, which can raise a 400, 408 or 413.
+		try:
+			if self.before_hooks or route is not None and route.before:
+				response = self.run_before_hooks(request, route)
+				if response is not None:
+					return response
+
+			if route is None:
+				return TinyResponse.error(404)
+			elif request.method not in route.methods:
+				return TinyResponse.error(405)
+
+			request.params = params
+
+			cache = route.cache
+			if cache is not None:
+				response = cache.lookup(request)
+				if response is not None:
+					return response
+
+			if admitted or self.limiter is None and route.limiter is None:
+				response = self.call(request, route, params)
 			else:
-				response = action_fun(request)
+				response = self.call_limited(request, route, params)
 
-		start_response(response.status, response.headers)
-		return response.body
+			if cache is not None:
+				response = cache.store(request, response)
+			return response
+		except TinyHTTPError as error:
+			return TinyResponse.error(error.status_code, error.headers)
+
+	def call_limited(self, request, route, params):
+		"""Calls a route's handler once the app's and the route's limiters admit
+		   the request. A request turned away gets a 503 with Retry-After, or a
+		   504 if its deadline passed while it waited."""
+
+		acquired = []
+		try:
+			for limiter in (self.limiter, route.limiter):
+				if limiter is None:
+					continue
+				if not limiter.acquire(request.deadline):
+					return TinyResponse.error(504) if request.expired else limiter.reject()
+				acquired.append(limiter)
+			return self.call(request, route, params)
+		finally:
+			for limiter in acquired:
+				limiter.release()
+
+	def call(self, request, route, params):
+		"""Calls a route's handler. A request past its deadline gets a 504 instead,
+		   whether the deadline passed before or while the handler ran."""
+
+		if request.expired:
+			return TinyResponse.error(504)
+
+		try:
+			response = route.call(request, params)
+			if _isawaitable(response):
+				response = _run_coroutine(response)
+		except TinyHTTPError as error:
+			return TinyResponse.error(error.status_code, error.headers)
+
+		if request.expired:
+			response.close()
+			return TinyResponse.error(504)
+		return response
 
 	def set_template_path(self, template_path):
-		"""Registers an absolute template path as the app's template directory."""
+		"""Registers an absolute template path as the app's template directory.
+		   Compiled templates from a previous path are dropped."""
 
 		self.template_path = template_path
+		self.templates.clear()
+
+	def get_template(self, template_name):
+		"""Returns the compiled TinyTemplate for a given template name.
+		   Templates are compiled once and kept in an LRU cache; a cached template
+		   is recompiled when its file's mtime changes (if auto reload is on)."""
+
+		path = os.path.join(self.template_path, template_name)
+		cached = self.templates.get(path)
+
+		if cached is not None and not self.template_auto_reload:
+			return cached[1]
+
+		mtime = os.path.getmtime(path)
+		if cached is None or cached[0] != mtime:
+			template = TinyTemplate.from_file(path)
+			self.templates.set(path, (mtime, template))
+			return template
+		return cached[1]
+
+	def reload_templates(self, template_name=None):
+		"""Drops a compiled template from the cache so it is recompiled on its
+		   next render. Drops every compiled template if no name is given."""
+
+		if template_name is None:
+			self.templates.clear()
+		else:
+			self.templates.pop(os.path.join(self.template_path, template_name))
 
-	# FIXME: Refactor this code to be easier to understand.
 	def render(self, template_name, *args, **kwargs):
 		"""Outputs text of an HTML file from a given template name.
 		   Assumes the template is coming from the registered templates dir."""
 
-		template_content = open(os.path.join(self.template_path, template_name)).read()
-		pattern = re.compile(r"({{\s?(\w+)\s?}})")
-		replacements = {k[0]: k[1] for k in kwargs.iteritems()}
-		template_vars = {k[0]: replacements[k[1]] for k in re.findall(pattern, template_content)}
-		replacement_pattern = re.compile('|'.join(["{{ %s }}" % (i) for i in replacements.keys()]))
-		replaced_content = replacement_pattern.sub(lambda m: template_vars[m.group(0)], template_content)
-		return replaced_content
+		timings = getattr(_current_timings, 'timings', None)
+		if timings is None:
+			return self.get_template(template_name).render(**kwargs)
+
+		started = _monotonic()
+		try:
+			return self.get_template(template_name).render(**kwargs)
+		finally:
+			timings.add('render', _monotonic() - started)
+
+	def render_stream(self, template_name, *args, **kwargs):
+		"""Same as render, but returns a generator of text chunks so large pages
+		   can be streamed to the client instead of built as one string."""
+
+		return self.get_template(template_name).stream(**kwargs)
 
 	def __call__(self, environ, start_response):
 		"""Makes the user's app a WSGI application. It is now callable by
@@ -83,6 +363,554 @@ class TinyApp(object):
 
 		return self.request_handler(environ, start_response)
 
+def _run_after_hooks(hooks, request, response):
+	"""Passes a response through after hooks; a hook returning None keeps it."""
+
+	for hook in hooks:
+		result = hook(request, response)
+		if result is not None:
+			response = result
+	return response
+
+### Routing ###
+
+def _arg_count(handler):
+	"""Returns the number of positional arguments a handler accepts.
+	   Bound methods don't count self; *args counts as one more argument."""
+
+	if not inspect.isfunction(handler) and not inspect.ismethod(handler):
+		handler = handler.__call__
+
+	getargspec = getattr(inspect, 'getfullargspec', None) or inspect.getargspec
+	spec = getargspec(handler)
+	arg_num = len(spec[0]) + (1 if spec[1] else 0)
+
+	if inspect.ismethod(handler) and handler.__self__ is not None:
+		arg_num -= 1
+	return arg_num
+
+class TinyRoute(object):
+	"""Represents a compiled route. Everything the dispatcher needs to call
+	   the handler (methods, path parameters, arity) is worked out once, when
+	   the route is added, instead of on every request."""
+
+	param_pattern = re.compile(r"^<(?:(\w+):)?(\w+)>$")
+
+	def __init__(self, pattern, handler, methods=['GET'], cache=None, before=None, after=None, limiter=None, timeout=None):
+		"""Splits the route pattern into segments. A segment is either a literal
+		   string or a (name, converter) pair for a path parameter."""
+
+		self.pattern = pattern
+		self.handler = handler
+		self.methods = frozenset(method.upper() for method in methods)
+		self.cache = cache
+		self.before = tuple(before or ())
+		self.after = tuple(after or ())
+		self.limiter = limiter
+		self.timeout = timeout
+
+		self.segments = []
+		for segment in (pattern.strip('/').split('/') if pattern != '/' else ['']):
+			param = self.param_pattern.match(segment)
+			if param:
+				converter_name = param.group(1) or 'str'
+				if converter_name not in TinyRouter.converters:
+					raise ValueError('Unknown path converter %r in route %r.' % (converter_name, pattern))
+				self.segments.append((param.group(2), converter_name))
+			else:
+				self.segments.append(segment)
+
+		self.param_names = [segment[0] for segment in self.segments if isinstance(segment, tuple)]
+		self.is_static = not self.param_names
+
+		if any(segment[1] == 'path' for segment in self.segments[:-1] if isinstance(segment, tuple)):
+			raise ValueError('A path parameter must be the last segment of route %r.' % pattern)
+
+		# If the handler takes more arguments than there are path parameters, the
+		# first one is the request.
+		self.takes_request = _arg_count(handler) > len(self.param_names)
+
+		# async def handlers are awaited on the event loop by the asyncio server.
+		self.is_async = _iscoroutinefunction(handler)
+
+	def call(self, request, params):
+		"""Calls the handler with the request (if it wants it) and path parameters."""
+
+		if self.takes_request:
+			return self.handler(request, **params)
+		return self.handler(**params)
+
+class _RouteNode(object):
+	"""A node of the router's segment trie."""
+
+	__slots__ = ('children', 'params', 'catch_all', 'route')
+
+	def __init__(self):
+		self.children = {}
+		self.params = []
+		self.catch_all = None
+		self.route = None
+
+class TinyRouter(object):
+	"""Dispatches request paths to routes. Static paths are found with a single
+	   dict lookup; parameterized routes live in a trie of path segments, so a
+	   lookup walks the path once no matter how many routes are registered."""
+
+	# Converts a path segment into a typed value; raising ValueError means no match.
+	converters = {
+		'str': lambda segment: segment,
+		'int': int,
+		'float': float,
+		'path': lambda segment: segment,
+	}
+
+	def __init__(self):
+		"""Creates an empty router."""
+
+		self.static = {}
+		self.root = _RouteNode()
+
+	def add(self, route):
+		"""Compiles a route into the static table or the segment trie."""
+
+		if route.is_static:
+			self.static[route.pattern] = route
+			return
+
+		node = self.root
+		for segment in route.segments:
+			if not isinstance(segment, tuple):
+				node = node.children.setdefault(segment, _RouteNode())
+			elif segment[1] == 'path':
+				node.catch_all = (segment[0], route)
+				return
+			else:
+				for name, converter_name, child in node.params:
+					if (name, converter_name) == segment:
+						node = child
+						break
+				else:
+					child = _RouteNode()
+					node.params.append((segment[0], segment[1], child))
+					node = child
+		node.route = route
+
+	def match(self, path, method):
+		"""Returns (route, params) for a path. A route that allows the method is
+		   preferred; otherwise a route that only matches the path is returned so
+		   the caller can answer 405. Returns (None, None) if nothing matches."""
+
+		static_route = self.static.get(path)
+		if static_route is not None and method in static_route.methods:
+			return static_route, {}
+
+		segments = path.strip('/').split('/') if path != '/' else ['']
+		fallback = [(static_route, {})] if static_route is not None else []
+		found = self._match(self.root, segments, 0, {}, method, fallback)
+
+		if found is not None:
+			return found
+		elif fallback:
+			return fallback[0]
+		return None, None
+
+	def _match(self, node, segments, index, params, method, fallback):
+		"""Walks the trie from a node. Literal children are tried before path
+		   parameters, which are tried before a trailing path parameter."""
+
+		if index == len(segments):
+			route = node.route
+			if route is None:
+				return None
+			elif method in route.methods:
+				return route, params
+			elif not fallback:
+				fallback.append((route, params))
+			return None
+
+		segment = segments[index]
+
+		child = node.children.get(segment)
+		if child is not None:
+			found = self._match(child, segments, index + 1, params, method, fallback)
+			if found is not None:
+				return found
+
+		if segment:
+			for name, converter_name, child in node.params:
+				try:
+					value = self.converters[converter_name](segment)
+				except ValueError:
+					continue
+				found = self._match(child, segments, index + 1, dict(params, **{name: value}), method, fallback)
+				if found is not None:
+					return found
+
+		if node.catch_all is not None and segment:
+			name, route = node.catch_all
+			params = dict(params, **{name: '/'.join(segments[index:])})
+			if method in route.methods:
+				return route, params
+			elif not fallback:
+				fallback.append((route, params))
+
+		return None
+
+### Templates ###
+
+class TinyTemplate(object):
+	"""Represents a compiled template. The template text is split once into
+	   literal chunks and variable names, so rendering only has to join the
+	   chunks with the variable values."""
+
+	pattern = re.compile(r"{{\s?(\w+)\s?}}")
+
+	# Streamed output is grouped into chunks of about this many characters.
+	buffer_size = 8192
+
+	def __init__(self, source):
+		"""Compiles the template source. Every odd chunk of the split is a variable
+		   name; its position is remembered so render can fill it in."""
+
+		self.chunks = self.pattern.split(source)
+		self.variables = [(index, self.chunks[index]) for index in range(1, len(self.chunks), 2)]
+
+	@classmethod
+	def from_file(cls, path):
+		"""Compiles the template stored at a given path."""
+
+		with io.open(path, encoding='utf-8') as template_file:
+			return cls(template_file.read())
+
+	def render(self, **kwargs):
+		"""Returns the rendered template as one string."""
+
+		chunks = list(self.chunks)
+		for index, name in self.variables:
+			chunks[index] = kwargs[name]
+		return ''.join(chunks)
+
+	def stream(self, **kwargs):
+		"""Returns a generator of rendered text. Small chunks are grouped until they
+		   reach buffer_size so the server isn't asked to write tiny pieces."""
+
+		chunks, buffer_size = self.chunks, self.buffer_size
+		values = [kwargs[name] for index, name in self.variables]
+
+		def generate():
+			buffered, size = [], 0
+			for index, chunk in enumerate(chunks):
+				if index % 2:
+					chunk = values[index // 2]
+				if not chunk:
+					continue
+				buffered.append(chunk)
+				size += len(chunk)
+				if size >= buffer_size:
+					yield ''.join(buffered)
+					buffered, size = [], 0
+			if buffered:
+				yield ''.join(buffered)
+
+		return generate()
+
+### Caching ###
+
+class TinyLRUCache(object):
+	"""A thread-safe mapping that holds at most max_size entries and evicts
+	   the least recently used entry once it is full."""
+
+	def __init__(self, max_size=128):
+		"""Creates an empty cache that holds at most max_size entries."""
+
+		self.max_size = max_size
+		self._data = collections.OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, key, default=None):
+		"""Returns the value for a key and marks it as recently used."""
+
+		with self._lock:
+			try:
+				value = self._data.pop(key)
+			except KeyError:
+				return default
+			self._data[key] = value
+			return value
+
+	def set(self, key, value):
+		"""Stores a value, evicting the least recently used entry if needed."""
+
+		with self._lock:
+			self._data.pop(key, None)
+			self._data[key] = value
+			while len(self._data) > self.max_size:
+				self._data.popitem(last=False)
+
+	def pop(self, key, default=None):
+		"""Removes a key and returns its value."""
+
+		with self._lock:
+			return self._data.pop(key, default)
+
+	def discard(self, key, value):
+		"""Removes a key if it still holds the given value, so an entry stored
+		   by another thread in the meantime is kept."""
+
+		with self._lock:
+			if self._data.get(key) is value:
+				del self._data[key]
+
+	def clear(self):
+		"""Removes every entry."""
+
+		with self._lock:
+			self._data.clear()
+
+	def __contains__(self, key):
+		"""Checks for a key without marking it as recently used."""
+
+		return key in self._data
+
+	def __len__(self):
+		"""Returns the number of cached entries."""
+
+		return len(self._data)
+
+class TinyResponseCache(object):
+	"""Caches the responses of a route, keyed by method, path and the query args
+	   named in query_args. Entries expire after ttl seconds and the least
+	   recently used entry is evicted once max_entries are held. Cached
+	   responses carry an ETag so a matching If-None-Match gets a 304 without
+	   calling the handler."""
+
+	def __init__(self, ttl=60, max_entries=256, query_args=()):
+		"""Creates an empty cache and its hit/miss counters."""
+
+		self.ttl = ttl
+		self.query_args = tuple(query_args)
+		self.entries = TinyLRUCache(max_entries)
+		self.hits = 0
+		self.misses = 0
+		self.lock = threading.Lock()
+
+	def key(self, request):
+		"""Returns the cache key of a request. HEAD shares GET's entries."""
+
+		method = 'GET' if request.method == 'HEAD' else request.method
+		if not self.query_args:
+			return (method, request.path)
+		get_data = request.get_data
+		return (method, request.path, tuple(tuple(get_data.getall(arg)) for arg in self.query_args))
+
+	def lookup(self, request):
+		"""Returns a response for the request from the cache, or None on a miss."""
+
+		if request.method not in ('GET', 'HEAD'):
+			return None
+
+		key = self.key(request)
+		entry = self.entries.get(key)
+		if entry is not None and entry[0] < _monotonic():
+			self.entries.discard(key, entry)
+			entry = None
+
+		with self.lock:
+			if entry is None:
+				self.misses += 1
+			else:
+				self.hits += 1
+		if entry is None:
+			return None
+
+		expires, status_code, headers, body, etag = entry
+		if _etag_matches(request.headers.get('If-None-Match'), etag):
+			return TinyResponse(None, 304, [('ETag', etag)])
+		return TinyResponse(body, status_code, headers)
+
+	def store(self, request, response):
+		"""Caches a fresh 200 response with a fully built body and returns the
+		   response to send, which is a 304 if the client already has it."""
+
+		if (request.method not in ('GET', 'HEAD') or response.status_code != 200 or response.file is not None
+				or not isinstance(response.body, list) or response.get_header('Set-Cookie') is not None):
+			return response
+
+		body = b''.join(response.body)
+		etag = response.get_header('ETag')
+		if etag is None:
+			etag = '"%s"' % hashlib.sha1(body).hexdigest()
+			response.set_header('ETag', etag)
+
+		self.entries.set(self.key(request), (_monotonic() + self.ttl, 200, list(response.headers), body, etag))
+
+		if _etag_matches(request.headers.get('If-None-Match'), etag):
+			return TinyResponse(None, 304, [('ETag', etag)])
+		return response
+
+	def clear(self):
+		"""Drops every cached response."""
+
+		self.entries.clear()
+
+def _etag_matches(if_none_match, etag):
+	"""Checks an If-None-Match header against an ETag, comparing weakly. The
+	   suffix TinyCompressor adds to the ETags of compressed bodies is ignored."""
+
+	if not if_none_match:
+		return False
+	elif if_none_match.strip() == '*':
+		return True
+
+	etag = etag[2:] if etag.startswith('W/') else etag
+	for candidate in if_none_match.split(','):
+		candidate = candidate.strip()
+		candidate = candidate[2:] if candidate.startswith('W/') else candidate
+		if candidate == etag or _encoding_suffix.sub('"', candidate) == etag:
+			return True
+	return False
+
+_encoding_suffix = re.compile(r'-(?:gzip|br)"$')
+
+### Compression ###
+
+class TinyCompressor(object):
+	"""Compresses responses with brotli (if installed) or gzip, as negotiated
+	   with Accept-Encoding. Small bodies and types that are already compressed
+	   are sent as they are; streamed bodies are compressed chunk by chunk.
+	   Bodies with an ETag (cached routes, static files) are compressed once
+	   and kept in a bounded cache."""
+
+	compressible_types = ('text/', 'application/json', 'application/javascript', 'application/xml',
+						  'application/x-ndjson', 'image/svg+xml')
+
+	def __init__(self, min_size=1024, level=6, cache_entries=256, max_cached_size=1024 * 1024):
+		"""Creates the compressor. Bodies under min_size bytes are skipped and
+		   only bodies up to max_cached_size bytes are cached."""
+
+		self.min_size = min_size
+		self.level = level
+		self.max_cached_size = max_cached_size
+		self.cache = TinyLRUCache(cache_entries)
+
+	def negotiate(self, accept_encoding):
+		"""Returns the encoding to use for an Accept-Encoding header, or None."""
+
+		accepted = {}
+		for item in accept_encoding.split(','):
+			coding, _, params = item.partition(';')
+			quality = 1.0
+			params = params.strip()
+			if params.startswith('q='):
+				try:
+					quality = float(params[2:])
+				except ValueError:
+					quality = 0.0
+			accepted[coding.strip().lower()] = quality
+
+		# The accepted coding with the highest q wins; brotli wins ties.
+		wildcard = accepted.get('*', 0.0)
+		best, best_quality = None, 0.0
+		for coding in ('br', 'gzip') if brotli is not None else ('gzip',):
+			quality = accepted.get(coding, wildcard)
+			if quality > best_quality:
+				best, best_quality = coding, quality
+		return best
+
+	def compress(self, request, response):
+		"""Returns the response with its body compressed, if it should be."""
+
+		status_code = response.status_code
+		if status_code < 200 or status_code >= 300 or status_code in (204, 206) or request.method == 'HEAD':
+			return response
+		elif response.get_header('Content-Encoding') is not None:
+			return response
+
+		content_type = response.get_header('Content-Type', '')
+		if not content_type.startswith(self.compressible_types):
+			return response
+		response.headers.append(('Vary', 'Accept-Encoding'))
+
+		encoding = self.negotiate(request.headers.get('Accept-Encoding', ''))
+		length = response.get_header('Content-Length')
+		if encoding is None or (length is not None and int(length) < self.min_size):
+			return response
+
+		# Only a strong ETag promises the same bytes, so only those key the cache.
+		etag = response.get_header('ETag')
+		strong_etag = etag is not None and not etag.startswith('W/')
+		if response.file is not None:
+			# Only files that can be cached are worth giving up sendfile for.
+			if not strong_etag or length is None or int(length) > self.max_cached_size:
+				return response
+			body = self.compress_cached(request, encoding, etag, lambda: response.file.read(int(length)))
+			response.file.close()
+			response.file = None
+		elif isinstance(response.body, list):
+			data = b''.join(response.body)
+			if strong_etag and len(data) <= self.max_cached_size:
+				body = self.compress_cached(request, encoding, etag, lambda: data)
+			else:
+				body = self.compress_data(encoding, data)
+		else:
+			# The length the app gave is the uncompressed one, so the stream is sent without one.
+			response.body = self.compress_stream(encoding, response.body)
+			response.headers = [header for header in response.headers if header[0].lower() != 'content-length']
+			body = None
+
+		if body is not None:
+			response.body = [body]
+			response.set_header('Content-Length', str(len(body)))
+		response.set_header('Content-Encoding', encoding)
+		if etag is not None and etag.endswith('"'):
+			response.set_header('ETag', '%s-%s"' % (etag[:-1], encoding))
+		return response
+
+	def compress_cached(self, request, encoding, etag, read):
+		"""Returns the compressed body for an ETag from the cache, compressing the
+		   body returned by read() on a miss. An ETag only tells apart versions of
+		   one resource (static files' are just mtime and size), so the URL is
+		   part of the key."""
+
+		key = (request.path, request.environ.get('QUERY_STRING', ''), etag, encoding)
+		body = self.cache.get(key)
+		if body is None:
+			body = self.compress_data(encoding, read())
+			self.cache.set(key, body)
+		return body
+
+	def compress_data(self, encoding, data):
+		"""Compresses a whole body."""
+
+		if encoding == 'br':
+			return brotli.compress(data, quality=min(self.level, 11))
+		compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+		return compressor.compress(data) + compressor.flush()
+
+	def compress_stream(self, encoding, chunks):
+		"""Compresses a streamed body as it is produced. Each chunk is flushed so
+		   the client gets data as soon as the app yields it."""
+
+		try:
+			if encoding == 'br':
+				compressor = brotli.Compressor(quality=min(self.level, 11))
+				for chunk in chunks:
+					data = compressor.process(chunk) + compressor.flush()
+					if data:
+						yield data
+				yield compressor.finish()
+			else:
+				compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+				for chunk in chunks:
+					data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+					if data:
+						yield data
+				yield compressor.flush()
+		finally:
+			close = getattr(chunks, 'close', None)
+			if close is not None:
+				close()
+
 ### Request and Response Classes ###
 
 class TinyRequest(object):
@@ -91,142 +919,1876 @@ class TinyRequest(object):
 	   (environment, queries, post data) to the request object so that it can
 	   be used elsewhere."""
 
+	# Request body limits. Bodies over max_body_size and in-memory form data over
+	# max_memory_size are refused with a 413; uploaded files over spill_size are
+	# written to a temporary file instead of memory.
+	max_body_size = None
+	max_memory_size = 2 * 1024 * 1024
+	spill_size = 512 * 1024
+	chunk_size = 64 * 1024
+
+	__slots__ = ('environ', 'path', 'method', 'params', 'route', 'timings', 'deadline', '_get_data', '_post_data', '_headers', '_cookies')
+
 	def __init__(self, environ):
-		"""Binds the request object to the user's request data."""
+		"""Binds the request object to the user's request data. Query args,
+		   post data, headers and cookies are only parsed when first used."""
 
 		self.environ = environ
 
-		self.path = self.environ.get('PATH_INFO', '/')
-		self.path = '/' + self.path if not self.path[0] == '/' else self.path
+		self.path = environ.get('PATH_INFO') or '/'
+		if self.path[0] != '/':
+			self.path = '/' + self.path
+
+		self.method = environ.get('REQUEST_METHOD', '').upper()
+
+		self.params = {}
+
+		# The matched TinyRoute, and the TinyTimings of the request if metrics are on.
+		self.route = None
+		self.timings = None
 
-		self.method = self.environ.get('REQUEST_METHOD', '').upper()
+		# When the route's timeout runs out, as a _monotonic() time; None if it has none.
+		self.deadline = None
 
 		self._get_data = None
 		self._post_data = None
+		self._headers = None
+		self._cookies = None
 
 	@property
 	def get_data(self):
-		"""Returns parsed dictionary of query string parameters."""
+		"""Returns parsed multi-value dictionary of query string parameters."""
 
-		if self.method == 'GET' and self._get_data is None:
-			self._get_data = self.get()
+		if self._get_data is None:
+			self._get_data = self.parse(self.get)
 		return self._get_data
 
 	@property
 	def post_data(self):
-		"""Returns parsed dictionary of post data."""
+		"""Returns parsed multi-value dictionary of post data."""
 
 		if self.method == 'POST' and self._post_data is None:
-			self._post_data = self.post()
+			self._post_data = self.parse(self.post)
 		return self._post_data
 
-	def get(self):
-		"""Parses the query string of a get request and returns it in 
-		   a dictionary."""
+	@property
+	def headers(self):
+		"""Returns a case-insensitive multi-value dictionary of request headers."""
 
-		form = cgi.FieldStorage(fp=self.environ.get('wsgi.input'), environ=self.environ)
-		get_dict = {key: form.getvalue(key) for key in form.keys()}
-		return get_dict
+		if self._headers is None:
+			self._headers = TinyHeaders.from_environ(self.environ)
+		return self._headers
 
-	def post(self):
-		"""Parses the data of a post request and returns it in a dictionary."""
+	@property
+	def cookies(self):
+		"""Returns a multi-value dictionary of the cookies sent with the request."""
 
-		form = cgi.FieldStorage(fp=self.environ.get('wsgi.input'), environ=self.environ)
-		post_dict = {key: form.getvalue(key) for key in form.keys()}
-		return post_dict
+		if self._cookies is None:
+			self._cookies = _parse_cookies(self.environ.get('HTTP_COOKIE', ''))
+		return self._cookies
 
-class TinyResponse(object):
-	"""Represents a response object. When a user makes a request, the app will 
-	   formulate the response based on the request data. Tiny binds that response 
-	   data to an object of this class."""
+	@property
+	def expired(self):
+		"""Whether the request's deadline has passed. Long handlers can check it
+		   to stop working on a request nobody is waiting for anymore."""
 
-	def __init__(self, body, status_code=200, headers=[('Content-Type', 'text/html')]):
-		"""Creates a response object that can hold the data for the HTTP response.
-		   Defaults to a '200' response with HTML content but allows user to 
-		   override."""
-		
-		self.body = body
-		self.status = "{0} {1}".format(status_code, HTTP_CODES[status_code][0])
-		self.headers = headers
+		return self.deadline is not None and _monotonic() >= self.deadline
 
-	@classmethod
-	def error(cls, status_code):
-		"""Returns a response object given a response class and a status code."""
+	def time_left(self):
+		"""Returns the seconds left until the deadline, or None if there is none."""
 
-		status_reason_phrase = HTTP_CODES[status_code][0]
-		status_url = HTTP_CODES[status_code][1]
-		body = '<a href="{0}"><h1>{1}: {2}</h1></a>'.format(status_url, status_code, status_reason_phrase)
-		return cls(body, status_code)
+		return None if self.deadline is None else self.deadline - _monotonic()
 
+	def parse(self, parser):
+		"""Calls a parser, charging its time to the parse stage if metrics are on."""
 
-# TODO: HTTP/WSGI Headers
+		if self.timings is None:
+			return parser()
 
-# Taken from http://www.w3.org/Protocols/rfc2616/rfc2616-sec6.html#sec6.1.1.
-HTTP_CODES = {
-	100: ('Continue', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.1.1'),
-	101: ('Switching Protocols', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.1.2'),
-	200: ('OK', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.2.1'),
-	201: ('Created', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.2.2'),
-	202: ('Accepted', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.2.3'),
-	203: ('Non-Authoritative Information', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.2.4'),
-	204: ('No Content', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.2.5'),
-	205: ('Reset Content', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.2.6'),
-	206: ('Partial Content', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.2.7'),
-	300: ('Multiple Choices', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.3.1'),
-	301: ('Moved Permanently', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.3.2'),
-	302: ('Found', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.3.3'),
-	303: ('See Other', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.3.4'),
-	304: ('Not Modified', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.3.5'),
-	305: ('Use Proxy', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.3.6'),
-	307: ('Temporary Redirect', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.3.8'),
-	400: ('Bad Request', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.1'),
-	401: ('Unauthorized', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.2'),
-	402: ('Payment Required', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.3'),
-	403: ('Forbidden', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.4'),
-	404: ('Not Found','http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.5'),
-	405: ('Method Not Allowed', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.6'),
-	406: ('Not Acceptable', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.7'),
-	407: ('Proxy Authentication Required', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.8'),
-	408: ('Request Timeout', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.9'),
-	409: ('Conflict', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.10'),
-	410: ('Gone', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.11'),
-	411: ('Length Required', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.12'),
-	412: ('Precondition Failed', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.13'),
-	413: ('Request Entity Too Large', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.14'),
-	414: ('Request-URI Too Long', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.15'),
-	415: ('Unsupported Media Type', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.16'),
-	416: ('Requested Range Not Satisfiable', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.17'),
-	417: ('Expectation Failed', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.18'),
-	500: ('Internal Server Error', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.5.1'),
-	501: ('Not Implemented', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.5.2'),
-	502: ('Bad Gateway', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.5.3'),
-	503: ('Service Unavailable', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.5.4'),
-	504: ('Gateway Timeout', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.5.5'),
-	505: ('HTTP Version Not Supported', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.5.6')
-}
+		started = _monotonic()
+		try:
+			return parser()
+		finally:
+			self.timings.add('parse', _monotonic() - started)
 
-# TODO: Error handling
+	def get(self):
+		"""Parses the query string of a request and returns it in a multi-value
+		   dictionary. Blank values are skipped."""
 
+		return _parse_query(self.environ.get('QUERY_STRING', ''))
 
-### Server and run script ###
+	def post(self):
+		"""Parses the data of a post request and returns it in a dictionary.
+		   Uploaded files are returned as TinyUpload objects."""
 
-def wsgiref_server(app, host='', port=8080):
-	"""Implements a WSGIref server and serves continuously.
-	   Can override default host and port if desired."""
+		parser = TinyFormParser(self.environ, self.max_body_size, self.max_memory_size,
+								self.spill_size, self.chunk_size, self.deadline)
+		return parser.parse()
+
+class TinyUpload(object):
+	"""Represents a file uploaded in a multipart form. The content is held in
+	   a file object that stays in memory for small files and spills to a
+	   temporary file for large ones."""
+
+	def __init__(self, name, filename, content_type, file):
+		"""Binds the form field name, the client's file name and the content."""
+
+		self.name = name
+		self.filename = filename
+		self.content_type = content_type
+		self.file = file
+
+	def read(self, *args):
+		"""Reads from the uploaded content."""
+
+		return self.file.read(*args)
+
+	def save(self, path, chunk_size=64 * 1024):
+		"""Copies the uploaded content to a path without loading it all at once."""
+
+		self.file.seek(0)
+		with open(path, 'wb') as destination:
+			for chunk in iter(lambda: self.file.read(chunk_size), b''):
+				destination.write(chunk)
+
+class TinyFormParser(object):
+	"""Incrementally parses an urlencoded or multipart request body. The body is
+	   read from wsgi.input in fixed-size chunks and never past CONTENT_LENGTH,
+	   so memory use doesn't grow with the size of an upload."""
+
+	def __init__(self, environ, max_body_size=None, max_memory_size=2 * 1024 * 1024,
+				 spill_size=512 * 1024, chunk_size=64 * 1024, deadline=None):
+		"""Binds the parser to a request environ and its limits. Reading the body
+		   past the deadline (a _monotonic() time) is answered with a 408."""
+
+		self.environ = environ
+		self.max_body_size = max_body_size
+		self.max_memory_size = max_memory_size
+		self.spill_size = spill_size
+		self.chunk_size = chunk_size
+		self.deadline = deadline
+
+		try:
+			self.content_length = int(environ.get('CONTENT_LENGTH') or 0)
+		except ValueError:
+			raise TinyHTTPError(400)
+
+		content_type = environ.get('CONTENT_TYPE', '')
+		self.content_type = content_type.split(';', 1)[0].strip().lower()
+		self.content_type_params = _header_params(content_type)
+
+	def parse(self):
+		"""Returns a multi-value dictionary of the body's fields."""
+
+		if self.max_body_size is not None and self.content_length > self.max_body_size:
+			raise TinyHTTPError(413)
+
+		if self.content_type == 'application/x-www-form-urlencoded':
+			return self.parse_urlencoded()
+		elif self.content_type == 'multipart/form-data':
+			return self.parse_multipart()
+		return TinyMultiDict()
+
+	def read_chunks(self):
+		"""Yields the body in chunks of at most chunk_size bytes."""
+
+		stream = self.environ.get('wsgi.input')
+		remaining = self.content_length
+
+		while remaining > 0:
+			chunk = stream.read(min(self.chunk_size, remaining))
+			if not chunk:
+				# The client went away before sending the whole body.
+				raise TinyHTTPError(400)
+			if self.deadline is not None and _monotonic() >= self.deadline:
+				raise TinyHTTPError(408)
+			remaining -= len(chunk)
+			yield chunk
+
+	def parse_urlencoded(self):
+		"""Parses an urlencoded body pair by pair as chunks arrive."""
+
+		if self.content_length > self.max_memory_size:
+			raise TinyHTTPError(413)
+
+		fields = TinyMultiDict()
+		pending = b''
+		for chunk in self.read_chunks():
+			pairs = (pending + chunk).split(b'&')
+			pending = pairs.pop()
+			for pair in pairs:
+				_add_urlencoded_pair(fields, pair)
+		_add_urlencoded_pair(fields, pending)
+		return fields
+
+	def parse_multipart(self):
+		"""Parses a multipart body with a small state machine. Only the bytes that
+		   may hold a partial boundary are kept between chunks; everything else
+		   goes straight into the current part."""
+
+		boundary = self.content_type_params.get('boundary')
+		if not boundary:
+			raise TinyHTTPError(400)
+		delimiter = b'\r\n--' + boundary.encode('latin-1')
+
+		fields = TinyMultiDict()
+		# Bytes held in memory: field values, plus uploads that haven't spilled to
+		# disk yet, which are kept in spooled as [file, size] pairs.
+		memory_used = 0
+		spooled = []
+		part = None
+		state = 'preamble'
+		# Treat the body as starting with a line break so the first boundary
+		# looks like every other delimiter.
+		buffer = b'\r\n'
+
+		for chunk in self.read_chunks():
+			buffer += chunk
+
+			while True:
+				if state == 'preamble':
+					index = buffer.find(delimiter)
+					if index < 0:
+						buffer = buffer[-len(delimiter):]
+						break
+					buffer = buffer[index + len(delimiter):]
+					state = 'boundary'
+
+				elif state == 'boundary':
+					if len(buffer) < 2:
+						break
+					if buffer[:2] == b'--':
+						return fields
+					buffer = buffer[2:]
+					state = 'headers'
+
+				elif state == 'headers':
+					index = buffer.find(b'\r\n\r\n')
+					if index < 0:
+						if len(buffer) > 16 * 1024:
+							raise TinyHTTPError(400)
+						break
+					part = self.start_part(buffer[:index])
+					if part[2] is not None:
+						spooled.append([part[3], 0])
+					buffer = buffer[index + 4:]
+					state = 'body'
+
+				elif state == 'body':
+					index = buffer.find(delimiter)
+					if index < 0:
+						# Keep just enough to find a boundary split across chunks.
+						keep = len(delimiter) - 1
+						data, buffer = buffer[:-keep], buffer[-keep:]
+					else:
+						data, buffer = buffer[:index], buffer[index + len(delimiter):]
+
+					part[3].write(data)
+					# Uploads already on disk take no memory however big they get.
+					if part[2] is None:
+						memory_used += len(data)
+					elif spooled and spooled[-1][0] is part[3]:
+						memory_used += len(data)
+						spooled[-1][1] += len(data)
+						if spooled[-1][1] > self.spill_size:
+							# The file rolled over to disk on its own.
+							memory_used -= spooled.pop()[1]
+
+					if memory_used > self.max_memory_size:
+						# Spill uploads still in memory before refusing the body.
+						while spooled and memory_used > self.max_memory_size:
+							target, size = spooled.pop()
+							target.rollover()
+							memory_used -= size
+						if memory_used > self.max_memory_size:
+							raise TinyHTTPError(413)
+
+					if index < 0:
+						break
+					self.finish_part(fields, part)
+					state = 'boundary'
+
+		# The body ended without a closing boundary.
+		raise TinyHTTPError(400)
+
+	def start_part(self, header_block):
+		"""Parses the headers of a part and returns (name, content type,
+		   file name, file object) for it."""
+
+		# Browsers send non-ASCII names and file names as raw UTF-8.
+		if not PY2:
+			try:
+				header_block = header_block.decode('utf-8')
+			except UnicodeDecodeError:
+				header_block = header_block.decode('latin-1')
+
+		headers = {}
+		for line in header_block.split('\r\n'):
+			key, _, value = line.partition(':')
+			headers[key.strip().lower()] = value.strip()
+
+		disposition = _header_params(headers.get('content-disposition', ''))
+		name = disposition.get('name')
+		filename = disposition.get('filename')
+		content_type = headers.get('content-type', 'text/plain')
+
+		if filename is None:
+			target = io.BytesIO()
+		else:
+			target = tempfile.SpooledTemporaryFile(max_size=self.spill_size)
+		return (name, content_type, filename, target)
+
+	def finish_part(self, fields, part):
+		"""Adds a finished part to the parsed fields."""
+
+		name, content_type, filename, target = part
+		if name is None:
+			return
+
+		if filename is None:
+			value = _to_text(target.getvalue())
+		else:
+			target.seek(0)
+			value = TinyUpload(name, filename, content_type, target)
+		fields.add(name, value)
+
+def _header_params(header):
+	"""Parses the ';'-separated parameters of a header value into a dict."""
+
+	params = {}
+	for key, quoted, plain in re.findall(r';\s*([\w-]+)\s*=\s*(?:"((?:[^"\\]|\\.)*)"|([^;\s]*))', header):
+		params[key.lower()] = quoted.replace('\\"', '"') if quoted else plain
+	return params
+
+def _add_urlencoded_pair(fields, pair):
+	"""Decodes one 'key=value' pair of an urlencoded body into the fields dict.
+	   Blank values are skipped."""
+
+	key, _, value = _to_native(pair).partition('=')
+	if value:
+		fields.add(unquote_plus(key), unquote_plus(value))
+
+def _parse_query(query):
+	"""Parses a query string into a multi-value dictionary. Only keys and values
+	   that hold escapes go through unquote_plus."""
+
+	args = TinyMultiDict()
+	if not query:
+		return args
+
+	for pair in query.split('&'):
+		key, _, value = pair.partition('=')
+		if not value:
+			continue
+		if '%' in key or '+' in key:
+			key = unquote_plus(key)
+		if '%' in value or '+' in value:
+			value = unquote_plus(value)
+		args.add(key, value)
+	return args
+
+def _parse_cookies(header):
+	"""Parses a Cookie header into a multi-value dictionary."""
+
+	cookies = TinyMultiDict()
+	for pair in header.split(';'):
+		name, _, value = pair.strip().partition('=')
+		if name:
+			if len(value) > 1 and value[0] == value[-1] == '"':
+				value = value[1:-1]
+			cookies.add(name, value)
+	return cookies
+
+class TinyMultiDict(Mapping):
+	"""A mapping that can hold several values per key, as query strings, forms,
+	   headers and cookies can. Looking up a key returns its first value;
+	   getall returns every value."""
+
+	__slots__ = ('_data',)
+
+	def __init__(self, pairs=()):
+		"""Creates the mapping from an iterable of (key, value) pairs."""
+
+		self._data = {}
+		for key, value in pairs:
+			self.add(key, value)
+
+	def add(self, key, value):
+		"""Adds a value for a key, keeping any values already there."""
+
+		self._data.setdefault(key, []).append(value)
+
+	def getall(self, key):
+		"""Returns a list of every value for a key."""
+
+		return list(self._data.get(key, ()))
+
+	def __getitem__(self, key):
+		"""Returns the first value for a key."""
+
+		return self._data[key][0]
+
+	def __iter__(self):
+		"""Iterates over the keys."""
+
+		return iter(self._data)
+
+	def __len__(self):
+		"""Returns the number of keys."""
+
+		return len(self._data)
+
+	def __repr__(self):
+		"""Shows every value of every key."""
+
+		return '%s(%r)' % (self.__class__.__name__, [(key, value) for key in self._data for value in self._data[key]])
+
+class TinyHeaders(TinyMultiDict):
+	"""A multi-value mapping of HTTP headers with case-insensitive names."""
+
+	__slots__ = ()
+
+	@classmethod
+	def from_environ(cls, environ):
+		"""Collects the request headers from a WSGI environ."""
+
+		headers = cls()
+		for key in environ:
+			if key.startswith('HTTP_'):
+				headers.add(key[5:], environ[key])
+			elif key in ('CONTENT_TYPE', 'CONTENT_LENGTH') and environ[key]:
+				headers.add(key, environ[key])
+		return headers
+
+	def add(self, key, value):
+		"""Adds a value for a header name."""
+
+		TinyMultiDict.add(self, key.replace('_', '-').title(), value)
+
+	def getall(self, key):
+		"""Returns a list of every value for a header name."""
+
+		return TinyMultiDict.getall(self, key.replace('_', '-').title())
+
+	def __getitem__(self, key):
+		"""Returns the first value for a header name."""
+
+		return self._data[key.replace('_', '-').title()][0]
+
+class TinyResponse(object):
+	"""Represents a response object. When a user makes a request, the app will 
+	   formulate the response based on the request data. Tiny binds that response 
+	   data to an object of this class."""
+
+	# Files are sent in blocks of this many bytes when the server can't sendfile.
+	block_size = 64 * 1024
+
+	def __init__(self, body, status_code=200, headers=None):
+		"""Creates a response object that can hold the data for the HTTP response.
+		   Defaults to a '200' response with HTML content but allows user to 
+		   override. A string body is sent as one chunk with a Content-Length;
+		   any other iterable (e.g. a generator) is streamed chunk by chunk."""
+		
+		self.status_code = status_code
+		self.status = "{0} {1}".format(status_code, HTTP_CODES[status_code][0])
+		self.headers = list(headers) if headers is not None else [('Content-Type', 'text/html; charset=utf-8')]
+		self.file = None
+		self.file_length = None
+
+		if body is None:
+			body = b''
+
+		if isinstance(body, (bytes, _text_type)):
+			self.body = [_to_bytes(body)]
+		elif isinstance(body, (list, tuple)):
+			self.body = [_to_bytes(chunk) for chunk in body]
+		else:
+			self.body = _encode_chunks(body)
+			return
+
+		# 204 and 304 responses have no body, so they carry no length either.
+		if status_code not in (204, 304):
+			self.set_default_header('Content-Length', str(sum(len(chunk) for chunk in self.body)))
+
+	@classmethod
+	def error(cls, status_code, headers=None):
+		"""Returns a response object given a response class and a status code.
+		   Extra headers, e.g. Retry-After, are added to the default ones."""
+
+		status_reason_phrase = HTTP_CODES[status_code][0]
+		status_url = HTTP_CODES[status_code][1]
+		body = '<a href="{0}"><h1>{1}: {2}</h1></a>'.format(status_url, status_code, status_reason_phrase)
+		response = cls(body, status_code)
+		for name, value in headers or ():
+			response.set_header(name, value)
+		return response
+
+	@classmethod
+	def from_file(cls, file, content_type=None, status_code=200, headers=None, length=None):
+		"""Returns a response that sends a file, given a path or an open binary file.
+		   The server's wsgi.file_wrapper (usually sendfile) is used if it has one.
+		   If length is given, only that many bytes from the file's current
+		   position are sent."""
+
+		if not hasattr(file, 'read'):
+			file = open(file, 'rb')
+
+		if content_type is None:
+			content_type = mimetypes.guess_type(getattr(file, 'name', ''))[0] or 'application/octet-stream'
+
+		response = cls(None, status_code, headers if headers is not None else [('Content-Type', content_type)])
+		response.file = file
+		response.body = None
+
+		if length is not None:
+			response.file_length = length
+			response.set_header('Content-Length', str(length))
+			return response
+
+		try:
+			size = os.fstat(file.fileno()).st_size - file.tell()
+		except (AttributeError, OSError, io.UnsupportedOperation):
+			response.headers = [header for header in response.headers if header[0].lower() != 'content-length']
+		else:
+			response.set_header('Content-Length', str(size))
+		return response
+
+	def get_header(self, name, default=None):
+		"""Returns the value of a response header, ignoring case."""
+
+		name = name.lower()
+		for key, value in self.headers:
+			if key.lower() == name:
+				return value
+		return default
+
+	def set_header(self, name, value):
+		"""Sets a response header, replacing any header with the same name."""
+
+		lower_name = name.lower()
+		self.headers = [header for header in self.headers if header[0].lower() != lower_name]
+		self.headers.append((name, value))
+
+	def set_default_header(self, name, value):
+		"""Sets a response header unless the user already set it."""
+
+		if self.get_header(name) is None:
+			self.headers.append((name, value))
+
+	def close(self):
+		"""Closes the body's file or generator, for a response that won't be sent."""
+
+		if self.file is not None:
+			self.file.close()
+		elif hasattr(self.body, 'close'):
+			self.body.close()
+
+	def wsgi_body(self, environ):
+		"""Returns the body as the iterable of bytes a WSGI server expects."""
+
+		if self.file is None:
+			return self.body
+		elif self.file_length is not None:
+			# Other servers' wrappers send the file to its end, so part of a file
+			# always goes through TinyFileWrapper (which tiny's servers sendfile).
+			return TinyFileWrapper(self.file, self.block_size, self.file_length)
+
+		file_wrapper = environ.get('wsgi.file_wrapper', TinyFileWrapper)
+		return file_wrapper(self.file, self.block_size)
+
+class TinyFileWrapper(object):
+	"""Iterates over a file in blocks. Used as the file wrapper when the WSGI
+	   server doesn't provide wsgi.file_wrapper."""
+
+	def __init__(self, file, block_size=64 * 1024, length=None):
+		"""Binds the file, the size of the blocks to read and, optionally, how
+		   many bytes to read in all."""
+
+		self.file = file
+		self.block_size = block_size
+		self.length = length
+
+		# Called after the file is closed; used by TinyMetrics to time the write.
+		self.on_close = None
+
+	def __iter__(self):
+		"""Yields the file's content block by block."""
+
+		read, block_size, remaining = self.file.read, self.block_size, self.length
+		if remaining is None:
+			block = read(block_size)
+			while block:
+				yield block
+				block = read(block_size)
+			return
+
+		while remaining > 0:
+			block = read(min(block_size, remaining))
+			if not block:
+				return
+			remaining -= len(block)
+			yield block
+
+	def close(self):
+		"""Closes the file; called by the server once the response is sent."""
+
+		self.file.close()
+		if self.on_close is not None:
+			self.on_close()
+
+def _to_bytes(data):
+	"""Encodes text as UTF-8; bytes are returned unchanged."""
+
+	return data.encode('utf-8') if isinstance(data, _text_type) else data
+
+def _encode_chunks(chunks):
+	"""Encodes the chunks of a streamed body as they are produced, passing the
+	   server's close() on to the original iterable."""
+
+	try:
+		for chunk in chunks:
+			yield _to_bytes(chunk)
+	finally:
+		close = getattr(chunks, 'close', None)
+		if close is not None:
+			close()
+
+def _json_dumps(value):
+	"""Serializes a value to compact JSON bytes."""
+
+	return _to_bytes(json.dumps(value, separators=(',', ':'), ensure_ascii=False))
+
+class TinyJSONResponse(TinyResponse):
+	"""A response with a JSON body. To use another serializer, subclass and set
+	   dumps to a function returning bytes or text, e.g.
+	   dumps = staticmethod(functools.partial(json.dumps, default=str)), or
+	   dumps = staticmethod(orjson.dumps) for speed. orjson is stricter than
+	   json: it refuses non-str dict keys unless given orjson.OPT_NON_STR_KEYS."""
+
+	dumps = staticmethod(_json_dumps)
+
+	# Streamed items are grouped into chunks of about this many bytes.
+	buffer_size = 64 * 1024
+
+	def __init__(self, data, status_code=200, headers=None):
+		"""Serializes data into a JSON body with a length."""
+
+		TinyResponse.__init__(self, self.dumps(data), status_code,
+							  headers if headers is not None else [('Content-Type', 'application/json')])
+
+	@classmethod
+	def stream(cls, items, ndjson=False, status_code=200, headers=None):
+		"""Returns a response that serializes an iterable (e.g. a generator of
+		   database rows) item by item while it is sent, as one JSON array or as
+		   newline-delimited JSON, so the whole result never sits in memory."""
+
+		content_type = 'application/x-ndjson' if ndjson else 'application/json'
+		response = cls.__new__(cls)
+		TinyResponse.__init__(response, cls.encode_stream(items, ndjson), status_code,
+							  headers if headers is not None else [('Content-Type', content_type)])
+		return response
+
+	@classmethod
+	def encode_stream(cls, items, ndjson=False):
+		"""Yields the serialized items in chunks of about buffer_size bytes. The first
+		   item is sent on its own so the client sees the response start right away."""
+
+		dumps, buffer_size = cls.dumps, cls.buffer_size
+		buffered, size = [] if ndjson else [b'['], 0
+		first = True
+
+		try:
+			for item in items:
+				data = _to_bytes(dumps(item))
+				if ndjson:
+					buffered.append(data)
+					buffered.append(b'\n')
+				else:
+					if not first:
+						buffered.append(b',')
+					buffered.append(data)
+				size += len(data) + 1
+
+				if first or size >= buffer_size:
+					yield b''.join(buffered)
+					buffered, size = [], 0
+				first = False
+
+			if not ndjson:
+				buffered.append(b']')
+			if buffered:
+				yield b''.join(buffered)
+		finally:
+			close = getattr(items, 'close', None)
+			if close is not None:
+				close()
+
+### Static Files ###
+
+class TinyStaticFiles(object):
+	"""Serves the files under a directory; registered with TinyApp.add_static.
+	   File stats and ETags are cached for stat_ttl seconds, bodies are sent
+	   as file responses, and conditional and Range requests are answered
+	   with 304, 206 and 416 responses."""
+
+	def __init__(self, directory, max_age=None, stat_ttl=1, max_entries=1024):
+		"""Binds the directory and creates the stat cache."""
+
+		self.root = os.path.realpath(directory)
+		self.max_age = max_age
+		self.stat_ttl = stat_ttl
+		self.stats = TinyLRUCache(max_entries)
+
+	def __call__(self, request, filename):
+		"""Returns the response for a file under the directory."""
+
+		if '\0' in filename:
+			return TinyResponse.error(404)
+
+		# Resolving symlinks and '..' first keeps every path inside the directory.
+		path = os.path.realpath(os.path.join(self.root, filename))
+		if not path.startswith(self.root + os.sep):
+			return TinyResponse.error(404)
+
+		info = self.stat(path)
+		if info is None:
+			return TinyResponse.error(404)
+		mtime, size, etag, last_modified, content_type = info
+
+		headers = [('Content-Type', content_type), ('ETag', etag), ('Last-Modified', last_modified), ('Accept-Ranges', 'bytes')]
+		if self.max_age is not None:
+			headers.append(('Cache-Control', 'max-age=%d' % self.max_age))
+
+		if self.not_modified(request, etag, mtime):
+			return TinyResponse(None, 304, [header for header in headers if header[0] != 'Content-Type'])
+
+		start, length, status_code = 0, size, 200
+		byte_range = self.byte_range(request, etag, size)
+		if byte_range == 'unsatisfiable':
+			response = TinyResponse.error(416)
+			response.set_header('Content-Range', 'bytes */%d' % size)
+			return response
+		elif byte_range is not None:
+			start, length, status_code = byte_range[0], byte_range[1] - byte_range[0] + 1, 206
+			headers.append(('Content-Range', 'bytes %d-%d/%d' % (byte_range[0], byte_range[1], size)))
+
+		if request.method == 'HEAD':
+			return TinyResponse(None, status_code, headers + [('Content-Length', str(length))])
+
+		try:
+			file = open(path, 'rb')
+		except (IOError, OSError):
+			return TinyResponse.error(404)
+		if status_code == 200:
+			# A whole file can go through the server's wsgi.file_wrapper (and sendfile).
+			return TinyResponse.from_file(file, status_code=status_code, headers=headers)
+		file.seek(start)
+		return TinyResponse.from_file(file, status_code=status_code, headers=headers, length=length)
+
+	def stat(self, path):
+		"""Returns (mtime, size, etag, last modified, content type) for a regular
+		   file, or None if there is none. Results are cached for stat_ttl seconds."""
+
+		now = _monotonic()
+		cached = self.stats.get(path)
+		if cached is not None and now - cached[0] < self.stat_ttl:
+			return cached[1]
+
+		try:
+			result = os.stat(path)
+		except OSError:
+			info = None
+		else:
+			if stat.S_ISREG(result.st_mode):
+				content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+				if content_type.startswith('text/'):
+					content_type += '; charset=utf-8'
+				info = (result.st_mtime, result.st_size, '"%x-%x"' % (int(result.st_mtime * 1000000), result.st_size),
+						email.utils.formatdate(result.st_mtime, usegmt=True), content_type)
+			else:
+				info = None
+
+		self.stats.set(path, (now, info))
+		return info
+
+	def not_modified(self, request, etag, mtime):
+		"""Checks If-None-Match, or else If-Modified-Since, against the file."""
+
+		headers = request.headers
+		if_none_match = headers.get('If-None-Match')
+		if if_none_match is not None:
+			return _etag_matches(if_none_match, etag)
+
+		if_modified_since = headers.get('If-Modified-Since')
+		if if_modified_since is not None:
+			since = email.utils.parsedate_tz(if_modified_since)
+			return since is not None and int(mtime) <= email.utils.mktime_tz(since)
+		return False
+
+	def byte_range(self, request, etag, size):
+		"""Returns the (first, last) byte positions asked for by a single Range
+		   header, 'unsatisfiable', or None to send the whole file. Multiple
+		   ranges and malformed headers are ignored."""
+
+		headers = request.headers
+		header = headers.get('Range')
+		if header is None or not header.startswith('bytes=') or ',' in header:
+			return None
+
+		if_range = headers.get('If-Range')
+		if if_range is not None and if_range != etag:
+			return None
+
+		first, _, last = header[6:].strip().partition('-')
+		try:
+			if not first:
+				suffix = int(last)
+				if suffix <= 0:
+					return 'unsatisfiable'
+				first, last = max(size - suffix, 0), size - 1
+			else:
+				first = int(first)
+				last = min(int(last), size - 1) if last else size - 1
+		except ValueError:
+			return None
+
+		if first > last:
+			return None if first <= size - 1 else 'unsatisfiable'
+		return first, last
+
+
+# Taken from http://www.w3.org/Protocols/rfc2616/rfc2616-sec6.html#sec6.1.1.
+HTTP_CODES = {
+	100: ('Continue', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.1.1'),
+	101: ('Switching Protocols', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.1.2'),
+	200: ('OK', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.2.1'),
+	201: ('Created', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.2.2'),
+	202: ('Accepted', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.2.3'),
+	203: ('Non-Authoritative Information', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.2.4'),
+	204: ('No Content', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.2.5'),
+	205: ('Reset Content', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.2.6'),
+	206: ('Partial Content', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.2.7'),
+	300: ('Multiple Choices', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.3.1'),
+	301: ('Moved Permanently', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.3.2'),
+	302: ('Found', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.3.3'),
+	303: ('See Other', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.3.4'),
+	304: ('Not Modified', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.3.5'),
+	305: ('Use Proxy', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.3.6'),
+	307: ('Temporary Redirect', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.3.8'),
+	400: ('Bad Request', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.1'),
+	401: ('Unauthorized', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.2'),
+	402: ('Payment Required', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.3'),
+	403: ('Forbidden', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.4'),
+	404: ('Not Found','http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.5'),
+	405: ('Method Not Allowed', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.6'),
+	406: ('Not Acceptable', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.7'),
+	407: ('Proxy Authentication Required', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.8'),
+	408: ('Request Timeout', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.9'),
+	409: ('Conflict', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.10'),
+	410: ('Gone', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.11'),
+	411: ('Length Required', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.12'),
+	412: ('Precondition Failed', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.13'),
+	413: ('Request Entity Too Large', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.14'),
+	414: ('Request-URI Too Long', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.15'),
+	415: ('Unsupported Media Type', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.16'),
+	416: ('Requested Range Not Satisfiable', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.17'),
+	417: ('Expectation Failed', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.18'),
+	500: ('Internal Server Error', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.5.1'),
+	501: ('Not Implemented', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.5.2'),
+	502: ('Bad Gateway', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.5.3'),
+	503: ('Service Unavailable', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.5.4'),
+	504: ('Gateway Timeout', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.5.5'),
+	505: ('HTTP Version Not Supported', 'http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.5.6')
+}
+
+### Admission Control ###
+
+class TinyLimiter(object):
+	"""Limits how many requests are handled at once, for an app (app.limiter)
+	   or a route (add_route(limiter=...)). Requests over the limit wait in a
+	   bounded queue for up to queue_timeout seconds; once the queue is full or
+	   the wait runs out they are turned away with a 503 right away, so the
+	   admitted requests keep a steady latency during a spike."""
+
+	def __init__(self, max_concurrent, max_queue=0, queue_timeout=1.0, retry_after=1):
+		"""Creates a limiter admitting max_concurrent requests at once, with room
+		   for max_queue more to wait. Turned away requests are told to retry
+		   after retry_after seconds."""
+
+		self.max_concurrent = max_concurrent
+		self.max_queue = max_queue
+		self.queue_timeout = queue_timeout
+		self.retry_after = retry_after
+
+		self.active = 0
+		self.waiting = 0
+		self.rejected = 0
+		self.condition = threading.Condition()
+
+	def acquire(self, deadline=None, blocking=True, queued_at=None):
+		"""Takes a slot, queueing for one if needed, and returns whether it got it.
+		   The wait ends early at the deadline (a _monotonic() time), if given.
+		   Without blocking, returns False instead of queueing. A request that
+		   took its place in the queue with enqueue() passes the time it did
+		   so as queued_at, and gives the place up either way."""
+
+		with self.condition:
+			if queued_at is None:
+				# Newcomers queue behind waiting requests instead of taking a freed slot.
+				if self.active < self.max_concurrent and not self.waiting:
+					self.active += 1
+					return True
+				elif not blocking:
+					return False
+				elif self.waiting >= self.max_queue:
+					self.rejected += 1
+					return False
+				queued_at = _monotonic()
+				self.waiting += 1
+
+			give_up = queued_at + self.queue_timeout
+			if deadline is not None:
+				give_up = min(give_up, deadline)
+
+			try:
+				# A place taken with enqueue() may have been held past the wait already.
+				while self.active >= self.max_concurrent or _monotonic() >= give_up:
+					remaining = give_up - _monotonic()
+					if remaining <= 0:
+						self.rejected += 1
+						return False
+					self.condition.wait(remaining)
+				self.active += 1
+				return True
+			finally:
+				self.waiting -= 1
+
+	def enqueue(self):
+		"""Takes a place in the queue without waiting, for a server that has its
+		   own queue to get through before it can call acquire, so the requests
+		   in it count toward max_queue. Returns whether there was room; every
+		   place is given up by a later acquire(queued_at=...) or dequeue()."""
+
+		with self.condition:
+			if self.active + self.waiting >= self.max_concurrent + self.max_queue:
+				self.rejected += 1
+				return False
+			self.waiting += 1
+			return True
+
+	def dequeue(self):
+		"""Gives up a place taken with enqueue() without taking a slot."""
+
+		with self.condition:
+			self.waiting -= 1
+
+	def release(self):
+		"""Gives a slot back and wakes the next waiting request."""
+
+		with self.condition:
+			self.active -= 1
+			self.condition.notify()
+
+	def reject(self):
+		"""Returns the response for a request that wasn't admitted."""
+
+		return TinyResponse.error(503, [('Retry-After', str(self.retry_after))])
+
+### Metrics ###
+
+class TinyTimings(object):
+	"""Times the stages of one request for TinyMetrics. The request's time is
+	   cut into consecutive stages by mark(); parse and render happen inside
+	   the handler, so they are added separately and left out of it."""
+
+	__slots__ = ('started', 'last', 'nested', 'stages')
+
+	def __init__(self):
+		"""Starts the clock."""
+
+		self.started = self.last = _monotonic()
+		self.nested = 0.0
+		self.stages = {}
+
+	def add(self, stage, seconds):
+		"""Adds time spent in a stage nested inside the current one."""
+
+		self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+		self.nested += seconds
+
+	def mark(self, stage):
+		"""Ends the current stage, charging it the time since the last mark less
+		   the nested stages."""
+
+		now = _monotonic()
+		self.stages[stage] = self.stages.get(stage, 0.0) + now - self.last - self.nested
+		self.last, self.nested = now, 0.0
+
+	@property
+	def total(self):
+		"""Returns the time from the start to the last mark."""
+
+		return self.last - self.started
+
+class TinyHistogram(object):
+	"""Counts observed values into buckets with fixed upper bounds."""
+
+	def __init__(self, buckets):
+		"""Creates an empty histogram; buckets is a sorted list of upper bounds."""
+
+		self.buckets = buckets
+		self.counts = [0] * (len(buckets) + 1)
+		self.sum = 0.0
+		self.count = 0
+
+	def observe(self, value):
+		"""Counts a value in the first bucket it fits in."""
+
+		self.counts[bisect.bisect_left(self.buckets, value)] += 1
+		self.sum += value
+		self.count += 1
+
+	def cumulative(self):
+		"""Returns (upper bound, count of values up to it) pairs, ending with '+Inf'."""
+
+		pairs, total = [], 0
+		for bound, count in zip(self.buckets + ['+Inf'], self.counts):
+			total += count
+			pairs.append((bound, total))
+		return pairs
+
+class TinyMetrics(object):
+	"""Collects per-route latency histograms for each stage of a request
+	   (routing, parse, handler, render, write, and the total) and counts the
+	   status codes sent. Set up by TinyApp.enable_metrics; an app without
+	   metrics pays for nothing but a few None checks."""
+
+	stages = ('routing', 'parse', 'handler', 'render', 'write', 'total')
+
+	# Upper bounds of the latency buckets, in seconds.
+	default_buckets = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+	# Longest profile the profile route will take, in seconds.
+	max_profile_seconds = 30
+
+	def __init__(self, buckets=None):
+		"""Creates empty metrics and a stopped profiler."""
+
+		self.buckets = sorted(buckets) if buckets is not None else list(self.default_buckets)
+		self.histograms = {}
+		self.statuses = {}
+		self.lock = threading.Lock()
+		self.profiler = TinyProfiler()
+		# Held while the profile route samples, so only one sample runs at a time.
+		self.profile_lock = threading.Lock()
+
+	def record(self, request, response, body):
+		"""Counts a response's status code and returns its body wrapped so the
+		   request's stages are recorded once the server has written it."""
+
+		route = request.route.pattern if request.route is not None else ''
+		key = (route, response.status_code)
+		with self.lock:
+			self.statuses[key] = self.statuses.get(key, 0) + 1
+
+		timings = request.timings
+		if timings is None:
+			return body
+
+		def written():
+			timings.mark('write')
+			self.observe(route, timings)
+
+		if isinstance(body, TinyFileWrapper):
+			body.on_close = written
+			return body
+		elif response.file is not None:
+			# The server's own wsgi.file_wrapper, which it can only sendfile while
+			# it still recognises it, so its close is hooked rather than wrapped.
+			close = getattr(body, 'close', None)
+			def close_and_record():
+				try:
+					if close is not None:
+						close()
+				finally:
+					written()
+			try:
+				body.close = close_and_record
+			except AttributeError:
+				written()
+			return body
+		elif isinstance(body, list):
+			return _TimedList(body, written)
+		return _TimedBody(body, written)
+
+	def observe(self, route, timings):
+		"""Adds a finished request's stage timings to the route's histograms."""
+
+		with self.lock:
+			for stage, seconds in list(timings.stages.items()) + [('total', timings.total)]:
+				histogram = self.histograms.get((route, stage))
+				if histogram is None:
+					histogram = self.histograms[(route, stage)] = TinyHistogram(self.buckets)
+				histogram.observe(seconds)
+
+	def clear(self):
+		"""Forgets everything recorded so far."""
+
+		with self.lock:
+			self.histograms.clear()
+			self.statuses.clear()
+
+	def render(self):
+		"""Returns the metrics in the Prometheus text exposition format."""
+
+		lines = ['# HELP tiny_request_duration_seconds Time spent in each stage of a request.',
+				 '# TYPE tiny_request_duration_seconds histogram']
+		with self.lock:
+			histograms = sorted((route, self.stages.index(stage), stage, histogram) for (route, stage), histogram in self.histograms.items())
+			for route, index, stage, histogram in histograms:
+				labels = 'route="%s",stage="%s"' % (_escape_label(route), stage)
+				for bound, count in histogram.cumulative():
+					lines.append('tiny_request_duration_seconds_bucket{%s,le="%s"} %d' % (labels, bound, count))
+				lines.append('tiny_request_duration_seconds_sum{%s} %r' % (labels, histogram.sum))
+				lines.append('tiny_request_duration_seconds_count{%s} %d' % (labels, histogram.count))
+
+			lines.extend(['# HELP tiny_responses_total Responses sent, by route and status code.',
+						  '# TYPE tiny_responses_total counter'])
+			for (route, status_code), count in sorted(self.statuses.items()):
+				lines.append('tiny_responses_total{route="%s",status="%d"} %d' % (_escape_label(route), status_code, count))
+		return '\n'.join(lines) + '\n'
+
+	def response(self):
+		"""The handler of the metrics route."""
+
+		return TinyResponse(self.render(), headers=[('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')])
+
+	def profile_response(self, request):
+		"""The handler of the profile route. If the profiler was switched on, returns
+		   what it has sampled so far; otherwise samples for ?seconds=N (default 1)
+		   and returns that, or a 409 if another sample is running. Stacks are in
+		   the collapsed format flame graph tools read."""
+
+		if self.profiler.running:
+			return TinyResponse(self.profiler.render(), headers=[('Content-Type', 'text/plain; charset=utf-8')])
+
+		try:
+			seconds = float(request.get_data.get('seconds', 1))
+		except ValueError:
+			raise TinyHTTPError(400)
+		# Also refuses nan, which fails every comparison.
+		if not 0 < seconds < float('inf'):
+			raise TinyHTTPError(400)
+		seconds = min(seconds, self.max_profile_seconds)
+
+		if not self.profile_lock.acquire(False):
+			raise TinyHTTPError(409)
+		profiler = TinyProfiler(self.profiler.interval)
+		try:
+			profiler.start()
+			time.sleep(seconds)
+		finally:
+			profiler.stop()
+			self.profile_lock.release()
+		return TinyResponse(profiler.render(), headers=[('Content-Type', 'text/plain; charset=utf-8')])
+
+def _escape_label(value):
+	"""Escapes a Prometheus label value."""
+
+	return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class _TimedList(list):
+	"""A list body that calls back when the server closes it."""
+
+	def __init__(self, body, callback):
+		list.__init__(self, body)
+		self.callback = callback
+
+	def close(self):
+		self.callback()
+
+class _TimedBody(object):
+	"""An iterable body that calls back when the server closes it."""
+
+	def __init__(self, body, callback):
+		self.body = body
+		self.callback = callback
+
+	def __iter__(self):
+		return iter(self.body)
+
+	def close(self):
+		try:
+			if hasattr(self.body, 'close'):
+				self.body.close()
+		finally:
+			self.callback()
+
+class TinyProfiler(object):
+	"""A sampling profiler that can be switched on and off while the app runs.
+	   While running, a background thread looks at the stack of every other
+	   thread each interval seconds and counts the stacks it sees; while
+	   stopped it costs nothing. Idle server threads show up in their waits."""
+
+	# Frames deeper than this are left out of a stack.
+	max_depth = 64
+
+	def __init__(self, interval=0.005):
+		"""Creates a stopped profiler."""
+
+		self.interval = interval
+		self.samples = {}
+		self.lock = threading.Lock()
+		self.thread = None
+		self.stopped = threading.Event()
+
+	@property
+	def running(self):
+		"""Whether the profiler is sampling."""
+
+		return self.thread is not None
+
+	def start(self):
+		"""Starts sampling in a background thread."""
+
+		with self.lock:
+			if self.thread is not None:
+				return
+			self.stopped.clear()
+			self.thread = threading.Thread(target=self.run, name='tiny-profiler')
+			self.thread.daemon = True
+			self.thread.start()
+
+	def stop(self):
+		"""Stops sampling. The samples are kept until clear() is called."""
+
+		with self.lock:
+			thread, self.thread = self.thread, None
+		if thread is not None:
+			self.stopped.set()
+			thread.join()
+
+	def clear(self):
+		"""Forgets the samples taken so far."""
+
+		with self.lock:
+			self.samples.clear()
+
+	def run(self):
+		"""Takes samples until stopped."""
+
+		own_id = threading.current_thread().ident
+		while not self.stopped.wait(self.interval):
+			for thread_id, frame in sys._current_frames().items():
+				if thread_id == own_id:
+					continue
+				stack = []
+				while frame is not None and len(stack) < self.max_depth:
+					code = frame.f_code
+					stack.append('%s (%s:%d)' % (code.co_name, code.co_filename, code.co_firstlineno))
+					frame = frame.f_back
+				key = ';'.join(reversed(stack))
+				with self.lock:
+					self.samples[key] = self.samples.get(key, 0) + 1
+
+	def render(self):
+		"""Returns the samples as collapsed stacks ('outer;inner count' lines),
+		   most frequent first."""
+
+		with self.lock:
+			samples = sorted(self.samples.items(), key=lambda item: (-item[1], item[0]))
+		return ''.join('%s %d\n' % sample for sample in samples)
+
+### Errors ###
+
+class TinyHTTPError(Exception):
+	"""Raised while handling a request to answer it with an HTTP error response."""
+
+	def __init__(self, status_code, headers=None):
+		"""Binds the HTTP status code of the error and any headers to send with it."""
+
+		Exception.__init__(self, status_code)
+		self.status_code = status_code
+		self.headers = headers
+
+
+### Server and run script ###
+
+def wsgiref_server(app, host='', port=8080):
+	"""Implements a WSGIref server and serves continuously.
+	   Can override default host and port if desired."""
 	
 	from wsgiref.simple_server import make_server
 
 	host_pretty = 'localhost' if host == '' else host
-	print 'Starting wsgiref_server at %s:%s' % (host_pretty, port)
+	print('Starting wsgiref_server at %s:%s' % (host_pretty, port))
 
 	server = make_server(host, port, app)
 	server.serve_forever()
 
-def run_app(app):
-	"""Runs a given app with a WSGIref server.
+class TinyInput(object):
+	"""Wraps the connection's input stream so the app can't read past the
+	   request body, and so what the app left unread can be skipped before the
+	   next request on a keep-alive connection."""
+
+	def __init__(self, stream, length):
+		"""Binds the stream and the number of body bytes it holds."""
+
+		self.stream = stream
+		self.remaining = length
+
+	def read(self, size=-1):
+		"""Reads at most size bytes (or the rest) of the body."""
+
+		if size is None or size < 0 or size > self.remaining:
+			size = self.remaining
+		data = self.stream.read(size) if size else b''
+		self.remaining -= len(data)
+		return data
+
+	def readline(self, size=-1):
+		"""Reads a line of the body."""
+
+		if size is None or size < 0 or size > self.remaining:
+			size = self.remaining
+		data = self.stream.readline(size) if size else b''
+		self.remaining -= len(data)
+		return data
+
+	def readlines(self, hint=None):
+		"""Reads the remaining lines of the body."""
+
+		return list(self)
+
+	def __iter__(self):
+		"""Iterates over the lines of the body."""
+
+		return iter(self.readline, b'')
+
+# Digits only: int() would also take signs, spaces and underscores.
+_content_length_pattern = re.compile(r'[0-9]+\Z')
+
+class TinyRequestHandler(BaseHTTPRequestHandler):
+	"""Speaks HTTP/1.1 to one client connection and runs the WSGI app for each
+	   request on it. Connections are kept alive until the client closes them,
+	   they go idle for keepalive_timeout seconds, or another connection is
+	   waiting for a thread while they are idle between requests."""
+
+	protocol_version = 'HTTP/1.1'
+	server_version = 'tiny'
+
+	# Leftover request bodies up to this size are skipped to keep the connection.
+	max_drain_size = 64 * 1024
+
+	# How often an idle connection checks whether its thread is wanted elsewhere, in seconds.
+	idle_check_interval = 0.05
+
+	def setup(self):
+		"""Applies the keep-alive timeout to the connection."""
+
+		self.timeout = self.server.keepalive_timeout
+		self.kept_alive = False
+		BaseHTTPRequestHandler.setup(self)
+
+	def handle_one_request(self):
+		"""Reads one request from the connection and answers it."""
+
+		if self.kept_alive and not self.wait_for_request():
+			self.close_connection = True
+			return
+
+		try:
+			self.raw_requestline = self.rfile.readline(65537)
+		except socket.error:
+			# Idle past the keep-alive timeout, or the client went away.
+			self.close_connection = True
+			return
+
+		if len(self.raw_requestline) > 65536:
+			self.send_error(414)
+			self.close_connection = True
+			return
+		elif not self.raw_requestline:
+			self.close_connection = True
+			return
+		elif not self.parse_request():
+			return
+		elif 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+			# Chunked request bodies aren't supported; ask for a Content-Length.
+			self.send_error(411)
+			self.close_connection = True
+			return
+
+		# A length we can't trust would leave part of the body to be read as the
+		# next request, so the connection is closed instead.
+		self.content_length = self.read_content_length()
+		if self.content_length is None:
+			self.send_error(400)
+			self.close_connection = True
+			return
+
+		self.run_app()
+		self.kept_alive = True
+
+		if self.server.stopping or not self.server.requests.empty():
+			# Free the thread for shutdown or for connections waiting their turn.
+			self.close_connection = True
+
+	def wait_for_request(self):
+		"""Waits for the next request on a kept-alive connection. Returns False if
+		   the connection should be closed instead: it went idle for
+		   keepalive_timeout seconds, the server is stopping, or a connection is
+		   waiting for the thread."""
+
+		# A pipelined request may already be buffered, where select can't see it.
+		if PY2:
+			if self.rfile._rbuf.getvalue():
+				return True
+		else:
+			self.connection.setblocking(False)
+			try:
+				if self.rfile.peek(1):
+					return True
+			except socket.error:
+				return False
+			finally:
+				self.connection.settimeout(self.timeout)
+
+		give_up = _monotonic() + self.timeout if self.timeout is not None else None
+		while not self.server.stopping and self.server.requests.empty():
+			wait = self.idle_check_interval
+			if give_up is not None:
+				wait = min(wait, give_up - _monotonic())
+				if wait <= 0:
+					return False
+			if select.select([self.connection], [], [], wait)[0]:
+				return True
+		return False
+
+	def read_content_length(self):
+		"""Returns the request's Content-Length (0 if it has none), or None unless it
+		   is one non-negative integer. Repeated values must all be the same."""
+
+		get_all = getattr(self.headers, 'get_all', None) or self.headers.getheaders
+		values = set(value.strip() for header in get_all('Content-Length') or [] for value in header.split(','))
+		if not values:
+			return 0
+
+		value = values.pop()
+		if values or not _content_length_pattern.match(value):
+			return None
+		return int(value)
+
+	def make_environ(self):
+		"""Builds the WSGI environ for the current request."""
+
+		path, _, query = self.path.partition('?')
+		environ = {
+			'REQUEST_METHOD': self.command,
+			'SCRIPT_NAME': '',
+			'PATH_INFO': unquote(path) if PY2 else unquote(path, 'latin-1'),
+			'QUERY_STRING': query,
+			'SERVER_NAME': self.server.server_name,
+			'SERVER_PORT': str(self.server.server_port),
+			'SERVER_PROTOCOL': self.request_version,
+			'REMOTE_ADDR': self.client_address[0],
+			'wsgi.version': (1, 0),
+			'wsgi.url_scheme': 'http',
+			'wsgi.errors': sys.stderr,
+			'wsgi.multithread': True,
+			'wsgi.multiprocess': self.server.multiprocess,
+			'wsgi.run_once': False,
+			'wsgi.file_wrapper': TinyFileWrapper,
+		}
+
+		for key, value in self.headers.items():
+			key = key.upper().replace('-', '_')
+			if key == 'CONTENT_LENGTH':
+				continue
+			elif key != 'CONTENT_TYPE':
+				key = 'HTTP_' + key
+			if key in environ:
+				value = environ[key] + ',' + value
+			environ[key] = value.strip()
+
+		environ['CONTENT_LENGTH'] = str(self.content_length)
+		environ['wsgi.input'] = TinyInput(self.rfile, self.content_length)
+		return environ
+
+	def run_app(self):
+		"""Calls the app and writes its response to the connection."""
+
+		environ = self.make_environ()
+		self.response_status = None
+		self.response_headers = None
+		self.headers_sent = False
+		self.chunked = False
+
+		try:
+			result = self.server.app(environ, self.start_response)
+			try:
+				if not self.send_file(result):
+					for data in result:
+						if data:
+							self.write(data)
+				if not self.headers_sent:
+					self.write(b'')
+				if self.chunked:
+					self.wfile.write(b'0\r\n\r\n')
+			finally:
+				if hasattr(result, 'close'):
+					result.close()
+		except Exception as error:
+			self.close_connection = True
+			if isinstance(error, socket.timeout) or getattr(error, 'errno', None) in (errno.EPIPE, errno.ECONNRESET):
+				# The client went away or stopped reading.
+				return
+			traceback.print_exc()
+			if not self.headers_sent:
+				response = TinyResponse.error(500)
+				self.start_response(response.status, response.headers)
+				self.write(response.body[0])
+			return
+
+		unread = environ['wsgi.input'].remaining
+		if unread > self.max_drain_size:
+			self.close_connection = True
+		elif unread:
+			environ['wsgi.input'].read()
+
+	def start_response(self, status, headers, exc_info=None):
+		"""The WSGI start_response callable."""
+
+		if exc_info:
+			try:
+				if self.headers_sent:
+					raise exc_info[1]
+			finally:
+				exc_info = None
+
+		self.response_status = status
+		self.response_headers = headers
+		return self.write
+
+	def header_block(self):
+		"""Returns the status line and headers of the response as bytes. Responses
+		   without a Content-Length are sent chunked on HTTP/1.1 connections."""
+
+		status_code = int(self.response_status[:3])
+		lines = ['%s %s\r\n' % (self.protocol_version, self.response_status)]
+		has_length = False
+
+		for name, value in self.response_headers:
+			lines.append('%s: %s\r\n' % (name, value))
+			if name.lower() == 'content-length':
+				has_length = True
+
+		if not has_length and status_code >= 200 and status_code not in (204, 304) and self.command != 'HEAD':
+			if self.request_version == 'HTTP/1.1':
+				self.chunked = True
+				lines.append('Transfer-Encoding: chunked\r\n')
+			else:
+				self.close_connection = True
+
+		if self.close_connection:
+			lines.append('Connection: close\r\n')
+		lines.append('Date: %s\r\nServer: %s\r\n\r\n' % (self.date_time_string(), self.server_version))
+
+		if not self.server.quiet:
+			self.log_request(status_code)
+		return ''.join(lines).encode('latin-1')
+
+	def send_file(self, result):
+		"""Sends a TinyFileWrapper body straight from the file to the socket with
+		   sendfile, if the platform has it. Returns whether it did."""
+
+		if not isinstance(result, TinyFileWrapper) or self.command == 'HEAD' or not hasattr(self.connection, 'sendfile'):
+			return False
+
+		length = [value for name, value in self.response_headers if name.lower() == 'content-length']
+		try:
+			result.file.fileno()
+		except (AttributeError, io.UnsupportedOperation):
+			return False
+		if not length:
+			return False
+
+		self.write(b'')
+		self.connection.sendfile(result.file, result.file.tell(), int(length[0]))
+		return True
+
+	def write(self, data):
+		"""Writes part of the body, sending the headers along with the first part."""
+
+		if self.command == 'HEAD':
+			data = b''
+
+		if self.headers_sent:
+			header_block = b''
+		else:
+			header_block = self.header_block()
+			self.headers_sent = True
+
+		if data and self.chunked:
+			data = ('%x\r\n' % len(data)).encode('ascii') + data + b'\r\n'
+		if header_block or data:
+			self.wfile.write(header_block + data)
+
+class TinyHTTPServer(HTTPServer):
+	"""An HTTP server that hands accepted connections to a fixed pool of
+	   threads. The queue in front of the pool is bounded, so a busy server
+	   stops accepting and lets the listen backlog absorb the excess."""
+
+	def __init__(self, app, sock, threads=8, keepalive_timeout=5, multiprocess=False, quiet=False):
+		"""Binds the server to an already listening socket and starts the pool."""
+
+		HTTPServer.__init__(self, sock.getsockname()[:2], TinyRequestHandler, bind_and_activate=False)
+		self.socket.close()
+		self.socket = sock
+		self.server_name, self.server_port = sock.getsockname()[:2]
+
+		self.app = app
+		self.keepalive_timeout = keepalive_timeout
+		self.multiprocess = multiprocess
+		self.quiet = quiet
+		self.stopping = False
+
+		self.requests = Queue(threads)
+		self.pool = []
+		for _ in range(threads):
+			thread = threading.Thread(target=self.process_request_thread)
+			thread.daemon = True
+			thread.start()
+			self.pool.append(thread)
+
+	def process_request(self, request, client_address):
+		"""Queues an accepted connection for the thread pool."""
+
+		self.requests.put((request, client_address))
+
+	def process_request_thread(self):
+		"""Serves queued connections until it is handed None."""
+
+		while True:
+			item = self.requests.get()
+			if item is None:
+				return
+			request, client_address = item
+			try:
+				self.finish_request(request, client_address)
+			except Exception:
+				self.handle_error(request, client_address)
+			finally:
+				self.shutdown_request(request)
+
+	def stop(self, timeout=30):
+		"""Stops accepting connections and waits up to timeout seconds for the
+		   threads to finish the requests they are serving."""
+
+		self.stopping = True
+		self.shutdown()
+		for _ in self.pool:
+			self.requests.put(None)
+
+		deadline = time.time() + timeout
+		for thread in self.pool:
+			thread.join(max(deadline - time.time(), 0))
+		self.server_close()
+
+def _listen(host, port, backlog=1024):
+	"""Returns a socket listening on host and port."""
+
+	sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+	sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	sock.bind((host, port))
+	sock.listen(backlog)
+	return sock
+
+def _serve_worker(app, sock, threads, keepalive_timeout, graceful_timeout, multiprocess, quiet):
+	"""Runs one worker: a TinyHTTPServer on the shared socket that stops
+	   gracefully on SIGTERM or SIGINT."""
+
+	server = TinyHTTPServer(app, sock, threads, keepalive_timeout, multiprocess, quiet)
+	stop = threading.Event()
+
+	signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+	signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+
+	thread = threading.Thread(target=server.serve_forever)
+	thread.daemon = True
+	thread.start()
+
+	# Waiting with a timeout keeps the main thread responsive to signals.
+	while not stop.is_set():
+		stop.wait(1)
+	server.stop(graceful_timeout)
+
+class TinyArbiter(object):
+	"""Runs a prefork server: the master process forks worker processes that
+	   share the listening socket, replaces workers that die, restarts them one
+	   by one on SIGHUP, and shuts them all down gracefully on SIGTERM/SIGINT."""
+
+	def __init__(self, app, sock, workers=2, threads=8, keepalive_timeout=5, graceful_timeout=30, quiet=False):
+		"""Binds the app, the listening socket and the worker settings."""
+
+		self.app = app
+		self.sock = sock
+		self.workers = workers
+		self.threads = threads
+		self.keepalive_timeout = keepalive_timeout
+		self.graceful_timeout = graceful_timeout
+		self.quiet = quiet
+
+		self.children = set()
+		self.stopping = False
+		self.reloading = False
+
+	def run(self):
+		"""Forks the workers and looks after them until told to stop."""
+
+		signal.signal(signal.SIGTERM, self.handle_stop)
+		signal.signal(signal.SIGINT, self.handle_stop)
+		signal.signal(signal.SIGHUP, self.handle_reload)
+
+		for _ in range(self.workers):
+			self.spawn()
+
+		while not self.stopping:
+			self.reap()
+			if self.reloading:
+				self.reloading = False
+				self.restart()
+			while len(self.children) < self.workers and not self.stopping:
+				self.spawn()
+			time.sleep(0.5)
+
+		self.kill_workers(self.children)
+
+	def handle_stop(self, signum, frame):
+		"""Signal handler that starts a graceful shutdown."""
+
+		self.stopping = True
+
+	def handle_reload(self, signum, frame):
+		"""Signal handler that starts a rolling restart."""
+
+		self.reloading = True
+
+	def spawn(self):
+		"""Forks a new worker process."""
+
+		pid = os.fork()
+		if pid:
+			self.children.add(pid)
+			return pid
+
+		signal.signal(signal.SIGHUP, signal.SIG_DFL)
+		try:
+			_serve_worker(self.app, self.sock, self.threads, self.keepalive_timeout, self.graceful_timeout, True, self.quiet)
+		except Exception:
+			traceback.print_exc()
+		finally:
+			os._exit(0)
+
+	def reap(self):
+		"""Forgets workers that have exited."""
+
+		while True:
+			try:
+				pid, _ = os.waitpid(-1, os.WNOHANG)
+			except OSError:
+				return
+			if not pid:
+				return
+			self.children.discard(pid)
+
+	def restart(self):
+		"""Replaces the workers one at a time, starting each new worker before
+		   stopping an old one so there is always a worker accepting."""
+
+		for pid in list(self.children):
+			if self.stopping:
+				return
+			self.spawn()
+			self.kill_workers([pid])
+
+	def kill_workers(self, pids):
+		"""Asks workers to stop and waits for them, killing any that are still
+		   running after graceful_timeout seconds."""
+
+		pids = set(pids)
+		for pid in pids:
+			try:
+				os.kill(pid, signal.SIGTERM)
+			except OSError:
+				pids.discard(pid)
+
+		deadline = time.time() + self.graceful_timeout
+		while pids and time.time() < deadline:
+			for pid in list(pids):
+				try:
+					finished, _ = os.waitpid(pid, os.WNOHANG)
+				except OSError:
+					finished = pid
+				if finished:
+					pids.discard(pid)
+					self.children.discard(pid)
+			time.sleep(0.1)
+
+		for pid in pids:
+			try:
+				os.kill(pid, signal.SIGKILL)
+				os.waitpid(pid, 0)
+			except OSError:
+				pass
+			self.children.discard(pid)
+
+def tiny_server(app, host='', port=8080, workers=1, threads=8, keepalive_timeout=5, graceful_timeout=30, quiet=False):
+	"""Implements a multi-process, multi-threaded HTTP/1.1 server and serves
+	   continuously. Forks worker processes sharing one listening socket, each
+	   serving connections from a pool of threads. Send SIGHUP to restart the
+	   workers one by one and SIGTERM to shut down gracefully. Pass quiet=True
+	   to skip the access log."""
+
+	host_pretty = 'localhost' if host == '' else host
+	print('Starting tiny_server at %s:%s with %s worker(s) of %s thread(s)' % (host_pretty, port, workers, threads))
+
+	sock = _listen(host, port)
+
+	if workers <= 1 or not hasattr(os, 'fork'):
+		_serve_worker(app, sock, threads, keepalive_timeout, graceful_timeout, False, quiet)
+	else:
+		TinyArbiter(app, sock, workers, threads, keepalive_timeout, graceful_timeout, quiet).run()
+
+def asyncio_server(app, host='', port=8080, threads=32, keepalive_timeout=5):
+	"""Serves the app on an asyncio event loop, which can hold many connections
+	   at once. async def handlers run on the loop; other handlers run in a pool
+	   of threads. Needs Python 3.7 or later; see tiny.aio."""
+
+	if sys.version_info < (3, 7):
+		raise RuntimeError('asyncio_server needs Python 3.7 or later.')
+
+	import asyncio
+	from . import aio
+
+	host_pretty = 'localhost' if host == '' else host
+	print('Starting asyncio_server at %s:%s' % (host_pretty, port))
+
+	asyncio.run(aio.serve(app, host, port, threads, keepalive_timeout))
+
+SERVERS = {
+	'wsgiref': wsgiref_server,
+	'tiny': tiny_server,
+	'asyncio': asyncio_server,
+}
+
+def run_app(app, server='wsgiref', **kwargs):
+	"""Runs a given app with a server from SERVERS, WSGIref by default.
 	   The server does this by invoking the 'callable' provided by the app.
-	   This is to WSGI specs."""
+	   This is to WSGI specs. Keyword arguments go to the server, e.g.
+	   run_app(app, 'tiny', workers=4, threads=16)."""
 
-	print 'wsgiref_server is invoking the WSGI callable object.'
+	server_fun = SERVERS[server]
+	print('%s is invoking the WSGI callable object.' % server_fun.__name__)
 
-	wsgiref_server(app)
\ No newline at end of file
+	server_fun(app, **kwargs)